@@ -0,0 +1,702 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Name: KonaDL Benchmarks
+Date Created: 16 Oct. 2026
+Last Modified: 16 Oct. 2026
+
+Licensed under the GNU General Public License Version 3 (GNU GPL v3),
+    available at: https://www.gnu.org/licenses/gpl-3.0.txt
+(C) 2018 K4YT3X
+
+Description: Offline benchmarks for libkonadl. Nothing in
+here talks to konachan.com or yande.re.
+
+Index page parser:
+    $ python3 konadl_bench.py parse
+    $ python3 konadl_bench.py parse --fixtures saved_pages/
+
+Work frontier memory:
+    $ python3 konadl_bench.py frontier
+
+Streaming API without storage:
+    $ python3 konadl_bench.py stream
+
+Crawl throughput against a local Moebooru stand-in:
+    $ python3 konadl_bench.py crawl
+    $ python3 konadl_bench.py update --source json
+    $ python3 konadl_bench.py crawl_page --latency 0.1
+    $ python3 konadl_bench.py crawl --throttle-rate 0.05 --crawlers 4 --downloaders 10 40
+"""
+import argparse
+import functools
+import hashlib
+import http.server
+import json
+import multiprocessing
+import os
+import queue
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+import libkonadl
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = False
+
+try:
+    import resource
+except ImportError:
+    resource = False  # Peak RSS is not reported on Windows
+
+RATING_NAMES = {'safe': 'Safe', 'questionable': 'Questionable', 'explicit': 'Explicit'}
+TAGS = ['original', 'long_hair', 'blush', 'sky', 'clouds', 'scenic', 'tree', 'water',
+        'building', 'night', 'stars', 'flowers', 'dress', 'sword', 'wings', 'snow']
+
+
+def image_payload(post_id, image_size):
+    # Reproducible image body of a fake post
+    seed = '{} '.format(post_id).encode()
+    return (seed * (image_size // len(seed) + 1))[:image_size]
+
+
+@functools.lru_cache(maxsize=65536)
+def image_md5(post_id, image_size):
+    return hashlib.md5(image_payload(post_id, image_size)).hexdigest()
+
+
+def variant_size(variant, image_size):
+    # JPEGs are half and samples an eighth of the original
+    return {'image': image_size, 'jpeg': image_size // 2, 'sample': image_size // 8}[variant]
+
+
+def synthetic_post(post_id, site_root='https://konachan.com', image_size=False):
+    """ Describes a fake post
+
+    Returns the same fields the Moebooru API returns for a
+    post, derived from the post id so that every page is
+    reproducible. With image_size the md5 is the one of
+    the image the stand-in server sends.
+    """
+    md5 = hashlib.md5(str(post_id).encode()).hexdigest()
+    if image_size:
+        md5 = image_md5(post_id, image_size)
+    rating = ['s', 'q', 'e'][post_id % 3]
+    tags = ' '.join(TAGS[(post_id + offset) % len(TAGS)] for offset in range(6))
+    name = 'Konachan.com%20-%20{}%20{}'.format(post_id, tags.replace(' ', '%20'))
+    return {'id': post_id,
+            'tags': tags,
+            'rating': rating,
+            'md5': md5,
+            'file_url': '{}/image/{}/{}.png'.format(site_root, md5, name),
+            'jpeg_url': '{}/jpeg/{}/{}.jpg'.format(site_root, md5, name),
+            'sample_url': '{}/sample/{}/{}.jpg'.format(site_root, md5, name),
+            'preview_url': '{}/data/preview/{}/{}/{}.jpg'.format(site_root, md5[0:2], md5[2:4], md5),
+            'file_size': image_size or 0,
+            'width': 1920,
+            'height': 1080,
+            'jpeg_file_size': variant_size('jpeg', image_size or 0),
+            'jpeg_width': 1920,
+            'jpeg_height': 1080,
+            'sample_file_size': variant_size('sample', image_size or 0),
+            'sample_width': 1500,
+            'sample_height': 844}
+
+
+def synthetic_index_page(page, total_pages, posts_per_page=21, newest_id=300000, site_root='https://konachan.com',
+                         oldest_id=1, image_size=False):
+    """ Renders a fake /post?page=N index page
+
+    Mimics the layout of a Moebooru index page: header
+    menus, a tag sidebar, the post list with thumbnails
+    and direct links, Post.register scripts and the
+    pagination bar.
+    """
+    first_id = newest_id - (page - 1) * posts_per_page
+    posts = [synthetic_post(post_id, site_root, image_size)
+             for post_id in range(first_id, first_id - posts_per_page, -1) if post_id >= oldest_id]
+    sections = ['<!DOCTYPE html><html><head><title>Konachan.com Anime Wallpapers</title>',
+                '<link rel="stylesheet" href="/assets/application.css" type="text/css">',
+                '<script src="/assets/application.js" type="text/javascript"></script></head><body>',
+                '<div id="header"><ul id="nav">']
+    for item in ['Posts', 'Comments', 'Notes', 'Artists', 'Tags', 'Pools', 'Wiki', 'Forum', 'Help']:
+        sections.append('<li><a href="/{0}">{0}</a></li>'.format(item.lower()))
+    sections.append('</ul></div><div id="content"><div class="sidebar"><div id="tag-sidebar"><ul>')
+    for tag in TAGS * 2:
+        sections.append('<li class="tag-type-general"><a href="/wiki/show?title={0}">?</a> '
+                        '<a href="/post?tags={0}">{0}</a> <span class="post-count">{1}</span></li>'.format(tag, len(tag) * 1000))
+    sections.append('</ul></div></div><div class="content"><div id="quick-edit" style="display: none;"></div>'
+                    '<ul id="post-list-posts">')
+    for post in posts:
+        alt = 'Rating: {} Score: {} Tags: {} User: someone'.format(
+            RATING_NAMES[libkonadl.RATINGS[post['rating']]], post['id'] % 97, post['tags'])
+        sections.append(
+            '<li style="width: 160px;" id="p{id}" class="creator-id-{creator} javascript-hide">'
+            '<div class="inner" style="width: 150px; height: 150px;">'
+            '<a class="thumb" href="/post/show/{id}/{slug}" ><img src="{preview}" alt="{alt}" class="preview" '
+            'title="{alt}" width="150" height="84"></a></div>'
+            '<a class="directlink largeimg" href="{url}"><span class="directlink-info">'
+            '<img class="directlink-icon directlink-icon-large" src="/images/ddl_large.gif" alt="">'
+            '<img class="directlink-icon directlink-icon-small" src="/images/ddl.gif" alt="">'
+            '<span class="directlink-res">1920 x 1080</span></span></a></li>'.format(
+                id=post['id'], creator=post['id'] % 5000, slug=post['tags'].replace(' ', '-'),
+                preview=post['preview_url'], alt=alt, url=post['file_url'].replace('https:', '')))
+    sections.append('</ul><div id="paginator"><div class="pagination">')
+    if page > 1:
+        sections.append('<a class="previous_page" rel="prev" href="/post?page={}&amp;tags=">&larr; Previous</a> '.format(page - 1))
+    for number in sorted(set([1, 2, page - 1, page, page + 1, total_pages - 1, total_pages])):
+        if number < 1 or number > total_pages:
+            continue
+        if number == page:
+            sections.append('<em class="current">{}</em> '.format(number))
+        else:
+            sections.append('<a href="/post?page={0}&amp;tags=">{0}</a> '.format(number))
+    if page < total_pages:
+        sections.append('<a class="next_page" rel="next" href="/post?page={}&amp;tags=">Next &rarr;</a>'.format(page + 1))
+    sections.append('</div></div></div></div><script type="text/javascript">')
+    for post in posts:
+        sections.append('Post.register({})\n'.format(json.dumps(post)))
+    sections.append('</script><div id="footer">')
+    for item in ['About', 'Terms of Service', 'Contact', 'Privacy', 'RSS', 'API', 'Changelog', 'Statistics', 'Donate']:
+        sections.append('<a href="/static/{0}">{0}</a> '.format(item.lower().replace(' ', '_')))
+    sections.append('</div></body></html>')
+    return ''.join(sections)
+
+
+def soup_parse_posts(page_text):
+    """ Reference BeautifulSoup parser
+
+    The full document parse libkonadl used before the
+    targeted extractor, kept here for comparison.
+    """
+    soup = BeautifulSoup(page_text, "html.parser")
+    posts = []
+    for post in soup.find('ul', {'id': 'post-list-posts'}).find_all('li'):
+        link = post.find('a', {'class': 'directlink'})
+        posts.append({'id': libkonadl.post_id_number(post['id']),
+                      'rating': libkonadl.alt_rating(post.find('img', alt=True)['alt']),
+                      'url': link['href'] if link else None})
+    return posts
+
+
+def load_fixtures(args):
+    # Reads saved index pages or renders synthetic ones
+    if args.fixtures:
+        pages = []
+        for file_name in sorted(os.listdir(args.fixtures)):
+            with open(os.path.join(args.fixtures, file_name), 'r', encoding='utf-8') as fixture:
+                pages.append(fixture.read())
+        return pages
+    return [synthetic_index_page(page, args.pages) for page in range(1, args.pages + 1)]
+
+
+def time_parser(parser, pages, repeat):
+    # Returns the best time of parsing all pages
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for page in pages:
+            parser(page)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_parse(args):
+    """ Index page parser micro-benchmark
+
+    Parses the same index pages with the BeautifulSoup
+    parse and with libkonadl.extract_posts, checks that
+    both find the same posts and prints the throughput.
+    """
+    if not BeautifulSoup:
+        print('Error: the parse benchmark needs beautifulsoup4 for comparison')
+        exit(1)
+    pages = load_fixtures(args)
+    page_bytes = sum(len(page.encode()) for page in pages)
+    for page in pages:
+        if soup_parse_posts(page) != libkonadl.extract_posts(page):
+            print('Error: extract_posts disagrees with BeautifulSoup')
+            exit(1)
+
+    print('{} pages, {} KiB'.format(len(pages), page_bytes // 1024))
+    results = {}
+    for name, parser in [('BeautifulSoup', soup_parse_posts), ('extract_posts', libkonadl.extract_posts)]:
+        results[name] = time_parser(parser, pages, args.repeat)
+        print('{:<15}{:>10.2f} ms{:>12.1f} pages/s'.format(
+            name, results[name] * 1000, len(pages) / results[name]))
+    print('Speedup: {:.1f}x'.format(results['BeautifulSoup'] / results['extract_posts']))
+
+
+def image_jobs(pages, posts_per_page=21):
+    # Yields the download jobs crawling this many pages produces
+    newest_id = pages * posts_per_page
+    for page in range(1, pages + 1):
+        for offset in range(posts_per_page):
+            post_id = newest_id - (page - 1) * posts_per_page - offset
+            yield (synthetic_post(post_id)['file_url'], page, 'safe')
+
+
+def frontier_peak_memory(make_queue, pages, crawling):
+    """ Peak memory of a queue holding a crawl's jobs
+
+    With crawling set, a producer thread puts every job with
+    a blocking put() while a consumer drains the queue more
+    slowly, like crawlers outrunning downloaders. Otherwise
+    every job is queued at once, like restored progress,
+    using put_overflow() where the queue has it. Returns the
+    peak amount of memory allocated in bytes.
+    """
+    job_queue = make_queue()
+    put_overflow = getattr(job_queue, 'put_overflow', job_queue.put)
+    tracemalloc.start()
+    if crawling:
+        def consume():
+            while True:
+                if job_queue.get() is None:
+                    break
+                time.sleep(0.00001)
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        for job in image_jobs(pages):
+            job_queue.put(job)
+        put_overflow(None)
+        consumer.join()
+    else:
+        for job in image_jobs(pages):
+            put_overflow(job)
+        while not job_queue.empty():
+            job_queue.get()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def benchmark_frontier(args):
+    """ Work frontier memory benchmark
+
+    Queues the image jobs of a growing number of index
+    pages into an unbounded queue.Queue and into
+    libkonadl.frontier_queue and prints the peak memory of
+    both. The frontier's peak has to stay flat no matter
+    how many pages are crawled; with --check the benchmark
+    exits with 1 if it grows beyond --tolerance times its
+    peak at the smallest page count.
+    """
+    spill_dir = tempfile.mkdtemp(prefix='konadl-bench-')
+    queues = [('queue.Queue', lambda: queue.Queue()),
+              ('frontier_queue', lambda: libkonadl.frontier_queue(args.maxsize, args.memory_items, spill_dir))]
+    failed = False
+    for crawling, title in [(True, 'Crawling (blocking put)'), (False, 'Restoring progress (put_overflow)')]:
+        print(title)
+        print('{:>8}{:>10}{:>18}{:>18}'.format('pages', 'jobs', 'queue.Queue', 'frontier_queue'))
+        frontier_peaks = []
+        for pages in sorted(args.pages):
+            peaks = [frontier_peak_memory(make_queue, pages, crawling) for _, make_queue in queues]
+            frontier_peaks.append(peaks[1])
+            print('{:>8}{:>10}{:>15.1f} KiB{:>15.1f} KiB'.format(pages, pages * 21, peaks[0] / 1024, peaks[1] / 1024))
+        if args.check and max(frontier_peaks) > frontier_peaks[0] * args.tolerance:
+            print('FAIL: frontier_queue peak grew from {:.1f} KiB to {:.1f} KiB'.format(
+                frontier_peaks[0] / 1024, max(frontier_peaks) / 1024))
+            failed = True
+        print()
+    os.rmdir(spill_dir)
+    if failed:
+        exit(1)
+
+
+class stand_in_handler(http.server.BaseHTTPRequestHandler):
+    """ Moebooru stand-in request handler
+
+    Serves /post index pages, /post.json, /post.xml and
+    image payloads for the posts newest_id down to 1 of
+    the server. "id:N..M" tag queries are honoured. Every
+    response is delayed by the server's latency, images
+    fail with a 500 or a 429 at the configured rates.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, content_type, status=200, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def post_range(self, query):
+        # Ids of the posts matching the search tags
+        oldest_id, newest_id = 1, self.server.newest_id
+        match = re.search(r'id:(\d+)\.\.(\d+)', query.get('tags', ''))
+        if match:
+            oldest_id = max(oldest_id, int(match.group(1)))
+            newest_id = min(newest_id, int(match.group(2)))
+        return oldest_id, newest_id
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        time.sleep(self.server.latency)
+        oldest_id, newest_id = self.post_range(query)
+        post_count = max(0, newest_id - oldest_id + 1)
+        if url.path == '/post':
+            page = int(query.get('page', 1))
+            total_pages = max(1, (post_count + self.server.posts_per_page - 1) // self.server.posts_per_page)
+            body = synthetic_index_page(page, total_pages, self.server.posts_per_page, newest_id,
+                                        self.server.site_root, oldest_id, self.server.image_size)
+            self.send_body(body.encode(), 'text/html; charset=utf-8')
+        elif url.path == '/post.json':
+            page = int(query.get('page', 1))
+            limit = int(query.get('limit', 100))
+            first_id = newest_id - (page - 1) * limit
+            posts = [synthetic_post(post_id, self.server.site_root, self.server.image_size)
+                     for post_id in range(first_id, max(first_id - limit, oldest_id - 1), -1)]
+            self.send_body(json.dumps(posts).encode(), 'application/json; charset=utf-8')
+        elif url.path == '/post.xml':
+            body = '<?xml version="1.0" encoding="UTF-8"?><posts count="{}" offset="0"></posts>'.format(post_count)
+            self.send_body(body.encode(), 'application/xml; charset=utf-8')
+        elif url.path.startswith(('/image/', '/jpeg/', '/sample/')):
+            roll = random.random()
+            if roll < self.server.throttle_rate:
+                self.send_body(b'', 'text/html', 429, {'Retry-After': '1'})
+                return
+            elif roll < self.server.throttle_rate + self.server.error_rate:
+                self.send_body(b'', 'text/html', 500)
+                return
+            post_id = int(re.search(r'/[^/]+%20-%20(\d+)%20', url.path).group(1))
+            image_size = variant_size(url.path.split('/')[1], self.server.image_size)
+            self.send_body(image_payload(post_id, image_size), 'image/png',
+                           headers={'ETag': '"{}"'.format(image_md5(post_id, image_size))})
+        else:
+            self.send_body(b'Not Found', 'text/html', 404)
+
+
+class stand_in_server(http.server.ThreadingHTTPServer):
+    """ Local Moebooru stand-in
+
+    Listens on a free port of 127.0.0.1 and serves posts
+    newest_id down to 1. The settings may be changed
+    between runs.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients closing a stream early reset the connection
+        pass
+
+    def __init__(self, newest_id, posts_per_page=21, image_size=100 * 1024, latency=0, error_rate=0, throttle_rate=0):
+        super().__init__(('127.0.0.1', 0), stand_in_handler)
+        self.site_root = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        self.newest_id = newest_id
+        self.posts_per_page = posts_per_page
+        self.image_size = image_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+
+
+class bench_konadl(libkonadl.konadl):
+    """ libkonadl pointed at the stand-in server
+
+    Keeps quiet and records the latency of every request
+    until the response headers arrived.
+    """
+
+    def __init__(self, site_root):
+        super().__init__()
+        self.bench_root = site_root
+        self.latencies = []
+        self.retries = 0
+
+    def process_network_options(self):
+        super().process_network_options()
+        self.site_root = self.bench_root
+        self.source = libkonadl.POST_SOURCES[self.post_source](self.site_root)
+
+    def fetch(self, url, budget='index', **kwargs):
+        start = time.perf_counter()
+        response = super().fetch(url, budget, **kwargs)
+        self.latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            self.retries += 1
+        return response
+
+    def write_traceback(self, url=False, page=False):
+        pass
+
+    def warn_keyboard_interrupt(self):
+        pass
+
+    def print_saving_progress(self):
+        pass
+
+    def print_loading_progress(self):
+        pass
+
+    def print_retrieval(self, url, page):
+        pass
+
+    def print_crawling_page(self, page):
+        pass
+
+    def print_thread_exit(self, name):
+        pass
+
+    def print_429(self):
+        pass
+
+    def print_exception(self):
+        pass
+
+
+def percentile(values, percent):
+    # Nearest rank percentile
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def run_scenario(settings, results):
+    """ Runs one scenario in a fresh process
+
+    Crawls the stand-in server with the given thread
+    counts into a temporary storage folder and puts the
+    measurements into the results queue. Running every
+    scenario in its own process keeps the peak RSS of
+    one run out of the next.
+    """
+    storage = tempfile.mkdtemp(prefix='konadl-bench-')
+    kona = bench_konadl(settings['site_root'])
+    kona.storage = '{}/'.format(storage)
+    kona.post_source = settings['source']
+    kona.safe = kona.questionable = kona.explicit = True
+    kona.post_crawler_threads_amount = settings['crawlers']
+    kona.downloader_threads_amount = settings['downloaders']
+    kona.adaptive_concurrency = settings['adaptive']
+    kona.variant = settings['variant']
+    kona.layout = settings['layout']
+    kona.fsync_batch = settings['fsync_batch']
+    kona.archive_format = settings['archive']
+    kona.index_rate = 0
+    kona.image_rate = 0
+
+    start = time.perf_counter()
+    if settings['scenario'] == 'crawl':
+        kona.pages = settings['pages']
+        kona.crawl()
+        pages = kona.pages
+    elif settings['scenario'] == 'crawl_page':
+        kona.crawl_page(settings['page'])
+        pages = 1
+    else:
+        # Pretend an earlier run saw everything but the new posts
+        kona.current_newest_id = settings['newest_id'] - settings['new_posts']
+        kona.save_metadata()
+        kona.current_newest_id = False
+        kona.update()
+        pages = kona.pages
+    elapsed = time.perf_counter() - start
+
+    image_bytes = 0
+    for relative_path, _ in kona.storage_images():
+        image_bytes += os.path.getsize(os.path.join(storage, relative_path))
+    if kona.archive_format:
+        archive_folder = os.path.join(storage, 'archives')
+        for file_name in os.listdir(archive_folder):
+            if file_name.endswith('.index'):
+                for entry in libkonadl.archive_entries(os.path.join(archive_folder, file_name)):
+                    image_bytes += entry['size']
+    kona.sessions.close()
+    kona.index.close()
+    shutil.rmtree(storage)
+    results.put({'elapsed': elapsed,
+                 'pages': pages,
+                 'images': kona.total_downloads,
+                 'bytes': image_bytes,
+                 'p50': percentile(kona.latencies, 50),
+                 'p99': percentile(kona.latencies, 99),
+                 'retries': kona.retries,
+                 'limits': (kona.crawler_concurrency.limit, kona.downloader_concurrency.limit),
+                 'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else 0})
+
+
+def benchmark_throughput(args):
+    """ Crawl throughput benchmark
+
+    Starts the stand-in server and runs the scenario
+    once for every combination of crawler and downloader
+    thread counts, each in its own process, printing
+    pages/s, images/s, MB/s, the p50/p99 request latency
+    and the peak RSS.
+    """
+    server = stand_in_server(args.posts, image_size=args.image_size, latency=args.latency,
+                             error_rate=args.error_rate, throttle_rate=args.throttle_rate)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    context = multiprocessing.get_context('spawn')
+
+    print('{} against {} ({} posts, {} KiB images, {} ms latency, {}% errors, {}% 429)'.format(
+        args.scenario, server.site_root, args.posts, args.image_size // 1024, args.latency * 1000,
+        args.error_rate * 100, args.throttle_rate * 100))
+    print('{:>8}{:>12}{:>8}{:>9}{:>10}{:>8}{:>9}{:>9}{:>9}{:>12}'.format(
+        'crawlers', 'downloaders', 'pages', 'pages/s', 'images/s', 'MB/s', 'p50 ms', 'p99 ms', 'retries', 'peak RSS'))
+    for crawlers in args.crawlers:
+        for downloaders in args.downloaders:
+            settings = {'scenario': args.scenario,
+                        'site_root': server.site_root,
+                        'source': args.source,
+                        'crawlers': crawlers,
+                        'downloaders': downloaders,
+                        'adaptive': args.adaptive,
+                        'pages': args.pages,
+                        'page': args.page,
+                        'newest_id': args.posts,
+                        'new_posts': args.new_posts,
+                        'variant': args.variant,
+                        'layout': args.layout,
+                        'fsync_batch': args.fsync_batch,
+                        'archive': args.archive}
+            results = context.Queue()
+            process = context.Process(target=run_scenario, args=(settings, results))
+            process.start()
+            result = results.get()
+            process.join()
+            print('{:>8}{:>12}{:>8}{:>9.1f}{:>10.1f}{:>8.1f}{:>9.1f}{:>9.1f}{:>9}{:>8.1f} MiB'.format(
+                crawlers, downloaders, result['pages'], result['pages'] / result['elapsed'],
+                result['images'] / result['elapsed'], result['bytes'] / result['elapsed'] / 1000000,
+                result['p50'] * 1000, result['p99'] * 1000, result['retries'], result['peak_rss'] / 1048576))
+            if args.adaptive:
+                print('{:>20} final limits: {} crawlers, {} downloaders'.format('', *result['limits']))
+    server.shutdown()
+    server.server_close()
+
+
+def prefetch_threads():
+    return sum(1 for thread in threading.enumerate() if thread.name.startswith(('Page Prefetcher', 'Image Prefetcher')))
+
+
+def benchmark_stream(args):
+    """ Streaming API benchmark
+
+    Starts the stand-in server and streams every post of
+    it through iter_posts and iter_downloads, printing
+    posts/s and MB/s, then leaves a second loop early.
+    The storage path given to konadl does not exist; the
+    benchmark exits with 1 if the iterators created it,
+    or if their prefetch threads outlive the loop.
+    """
+    server = stand_in_server(args.posts, image_size=args.image_size, latency=args.latency)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    storage = os.path.join(tempfile.mkdtemp(prefix='konadl-bench-'), 'missing')
+    kona = bench_konadl(server.site_root)
+    kona.storage = '{}/'.format(storage)
+    kona.post_source = args.source
+    kona.safe = kona.questionable = kona.explicit = True
+    kona.index_rate = 0
+    kona.image_rate = 0
+    failed = False
+
+    print('stream against {} ({} posts, {} KiB images, {} ms latency)'.format(
+        server.site_root, args.posts, args.image_size // 1024, args.latency * 1000))
+    start = time.perf_counter()
+    posts = image_bytes = 0
+    for post, stream in kona.iter_downloads(prefetch=args.prefetch):
+        image_bytes += len(stream.read())
+        posts += 1
+    elapsed = time.perf_counter() - start
+    print('{:>8} posts {:>9.1f} posts/s {:>8.1f} MB/s'.format(posts, posts / elapsed, image_bytes / elapsed / 1000000))
+    if posts != args.posts:
+        print('FAIL: streamed {} of {} posts'.format(posts, args.posts))
+        failed = True
+
+    for post, stream in kona.iter_downloads(prefetch=args.prefetch):
+        break
+    # Threads check the stop event at least once a second
+    deadline = time.monotonic() + 5
+    while prefetch_threads() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    if prefetch_threads():
+        print('FAIL: {} prefetch threads still running after leaving the loop'.format(prefetch_threads()))
+        failed = True
+    if os.path.exists(storage):
+        print('FAIL: the iterators created {}'.format(storage))
+        failed = True
+    kona.sessions.close()
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(os.path.dirname(storage))
+    if failed:
+        exit(1)
+
+
+def process_arguments():
+    """This function parses all arguments
+    """
+    parser = argparse.ArgumentParser()
+    scenarios = parser.add_subparsers(dest='scenario')
+    parse_parser = scenarios.add_parser('parse', help='Index page parser micro-benchmark')
+    parse_parser.add_argument('--fixtures', help='Directory of saved index pages', action='store', default=False)
+    parse_parser.add_argument('--pages', help='Number of synthetic pages', type=int, action='store', default=50)
+    parse_parser.add_argument('--repeat', help='Timing repetitions', type=int, action='store', default=5)
+    frontier_parser = scenarios.add_parser('frontier', help='Work frontier peak memory')
+    frontier_parser.add_argument('--pages', help='Page counts to compare', type=int, nargs='+', action='store', default=[100, 1000, 5000])
+    frontier_parser.add_argument('--maxsize', help='Frontier backpressure limit', type=int, action='store', default=500)
+    frontier_parser.add_argument('--memory-items', help='Frontier jobs kept in memory', type=int, action='store', default=1000)
+    frontier_parser.add_argument('--check', help='Exit with 1 if the frontier peak does not stay flat', action='store_true', default=False)
+    frontier_parser.add_argument('--tolerance', help='Growth of the frontier peak --check allows', type=float, action='store', default=1.5)
+    stream_parser = scenarios.add_parser('stream', help='iter_posts / iter_downloads without storage')
+    stream_parser.add_argument('--source', help='Index backend', choices=libkonadl.POST_SOURCES.keys(), action='store', default='html')
+    stream_parser.add_argument('--posts', help='Posts on the stand-in server', type=int, action='store', default=420)
+    stream_parser.add_argument('--image-size', help='Image size in bytes', type=int, action='store', default=100 * 1024)
+    stream_parser.add_argument('--latency', help='Response latency in seconds', type=float, action='store', default=0.02)
+    stream_parser.add_argument('--prefetch', help='Images opened ahead of the loop', type=int, action='store', default=4)
+    for scenario, help_text in [('crawl', 'Crawl the first pages of the stand-in server'),
+                                ('update', 'Update after new posts were added'),
+                                ('crawl_page', 'Crawl a single page')]:
+        scenario_parser = scenarios.add_parser(scenario, help=help_text)
+        scenario_parser.add_argument('--source', help='Index backend', choices=libkonadl.POST_SOURCES.keys(), action='store', default='html')
+        scenario_parser.add_argument('--posts', help='Posts on the stand-in server', type=int, action='store', default=2100)
+        scenario_parser.add_argument('--pages', help='Pages to crawl (crawl)', type=int, action='store', default=10)
+        scenario_parser.add_argument('--page', help='Page to crawl (crawl_page)', type=int, action='store', default=1)
+        scenario_parser.add_argument('--new-posts', help='Posts added since the last run (update)', type=int, action='store', default=210)
+        scenario_parser.add_argument('--image-size', help='Image size in bytes', type=int, action='store', default=100 * 1024)
+        scenario_parser.add_argument('--latency', help='Response latency in seconds', type=float, action='store', default=0.02)
+        scenario_parser.add_argument('--error-rate', help='Share of images failing with a 500', type=float, action='store', default=0)
+        scenario_parser.add_argument('--throttle-rate', help='Share of images refused with a 429', type=float, action='store', default=0)
+        scenario_parser.add_argument('--variant', help='File downloaded per post', choices=['original', 'jpeg', 'sample', 'smallest'], action='store', default='original')
+        scenario_parser.add_argument('--layout', help='Storage layout', choices=libkonadl.LAYOUTS, action='store', default='flat')
+        scenario_parser.add_argument('--fsync-batch', help='Images fsynced at once, 0 for none', type=int, action='store', default=64)
+        scenario_parser.add_argument('--archive', help='Pack the images into tar or zip shards', choices=['tar', 'zip'], action='store', default=False)
+        scenario_parser.add_argument('--adaptive', help='Let the concurrency controller move the thread counts', action='store_true', default=False)
+        scenario_parser.add_argument('--crawlers', help='Crawler thread counts', type=int, nargs='+', action='store', default=[2, 10])
+        scenario_parser.add_argument('--downloaders', help='Downloader thread counts', type=int, nargs='+', action='store', default=[5, 20])
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = process_arguments()
+    if args.scenario == 'parse':
+        benchmark_parse(args)
+    elif args.scenario == 'frontier':
+        benchmark_frontier(args)
+    elif args.scenario == 'stream':
+        benchmark_stream(args)
+    elif args.scenario in ('crawl', 'update', 'crawl_page'):
+        benchmark_throughput(args)
+    else:
+        print('Please choose a benchmark, use --help for more information')
+        exit(1)
@@ -11,14 +11,22 @@ Licensed under the GNU General Public License Version 3 (GNU GPL v3),
 """
 
 from libkonadl import konadl  # Import libkonadl
+from libkonadl import byte_size
 from libkonadl import print_locker
 import argparse
 import avalon_framework as avalon
+import logging
 import os
+import subprocess
+import sys
 import time
 import traceback
 
 VERSION = '1.3.6'
+PINNED_OPTIONS = {'safe': 'safe', 'questionable': 'questionable', 'explicit': 'explicit', 'source': 'post_source',
+                  'tags': 'tags', 'content_addressed': 'content_addressed', 'archive': 'archive_format',
+                  'archive_size': 'archive_size', 'variant': 'variant', 'min_resolution': 'min_resolution',
+                  'max_file_size': 'max_file_size', 'max_resolution': 'max_resolution'}
 
 
 def process_arguments():
@@ -32,20 +40,59 @@ def process_arguments():
     control_group.add_argument('-n', '--pages', help='Number of pages to download', type=int, action='store', default=False)
     control_group.add_argument('-a', '--all', help='Download all images', action='store_true', default=False)
     control_group.add_argument('-p', '--page', help='Crawl a specific page', type=int, action='store', default=False)
+    control_group.add_argument('-t', '--tags', help='Only download posts matching this tag query, e.g. "landscape -sky"', action='store', default='')
     control_group.add_argument('-y', '--yandere', help='Crawl Yande.re site', action='store_true', default=False)
     control_group.add_argument('-o', '--storage', help='Storage directory', action='store', default=False)
     control_group.add_argument('--separate', help='Separate images into folders by ratings', action='store_true', default=False)
+    control_group.add_argument('--content-addressed', help='Store every image once under objects/ by md5 and hardlink it into place', action='store_true', default=False)
+    control_group.add_argument('--layout', help='Spread images over folders by the md5 of their file name or by post id range', choices=['flat', 'md5', 'id'], action='store', default=False)
+    control_group.add_argument('--migrate-layout', help='Move the images in storage into this layout and exit', choices=['flat', 'md5', 'id'], action='store', default=False)
+    control_group.add_argument('--archive', help='Pack images into rolling tar or zip shards under archives/ instead of one file each', choices=['tar', 'zip'], action='store', default=False)
+    control_group.add_argument('--archive-size', help='Bytes per archive shard before the next one is started, e.g. 4G', type=byte_size, action='store', default=1024 ** 3)
+    control_group.add_argument('--plan', help='Only count the images and bytes -n, -a or -p would download and exit', action='store_true', default=False)
+    control_group.add_argument('--retry-failed', help='Only download the jobs in dead_letters.jsonl again', action='store_true', default=False)
     control_group.add_argument('-u', '--update', help='Update new images', action='store_true', default=False)
+    control_group.add_argument('--import-index', help='Record images already in storage in the download index and exit', action='store_true', default=False)
+    control_group.add_argument('--no-index', help='Download posts even if they are in the download index', action='store_true', default=False)
+    control_group.add_argument('--no-page-cache', help='Fetch index pages in full instead of revalidating cached ones', action='store_true', default=False)
+    control_group.add_argument('--coordinator', help='Crawl all pages as one of many worker processes sharing the shard leases in this SQLite file', action='store', default=False)
+    control_group.add_argument('--source', help='Post index backend: html pages or the json API', choices=['html', 'json'], action='store', default='html')
+    control_group.add_argument('--variant', help='File to download: the original, its JPEG, the sample or the smallest reaching --min-resolution', choices=['original', 'jpeg', 'sample', 'smallest'], action='store', default='original')
+    control_group.add_argument('--min-resolution', help='Pixels on the long side --variant smallest has to reach', type=int, action='store', default=0)
+    control_group.add_argument('--max-file-size', help='Skip images larger than this many bytes, e.g. 5M', type=byte_size, action='store', default=0)
+    control_group.add_argument('--max-resolution', help='Skip images with more pixels than this on the long side', type=int, action='store', default=0)
     ratings_group = parser.add_argument_group('Ratings')
     ratings_group.add_argument('-s', '--safe', help='Include Safe rated images', action='store_true', default=False)
     ratings_group.add_argument('-q', '--questionable', help='Include Questionable rated images', action='store_true', default=False)
     ratings_group.add_argument('-e', '--explicit', help='Include Explicit rated images', action='store_true', default=False)
     threading_group = parser.add_argument_group('Threading')
-    threading_group.add_argument('-c', '--crawlers', help='Number of post crawler threads', type=int, action='store', default=10)
-    threading_group.add_argument('-d', '--downloaders', help='Number of downloader threads', type=int, action='store', default=20)
+    threading_group.add_argument('-c', '--crawlers', help='Number of post crawler threads to start with', type=int, action='store', default=10)
+    threading_group.add_argument('-d', '--downloaders', help='Number of downloader threads to start with', type=int, action='store', default=20)
+    threading_group.add_argument('--max-crawlers', help='Most post crawler threads running at once', type=int, action='store', default=20)
+    threading_group.add_argument('--max-downloaders', help='Most downloader threads running at once', type=int, action='store', default=40)
+    threading_group.add_argument('--fixed-threads', help='Keep the thread counts of -c and -d instead of adapting them', action='store_true', default=False)
+    threading_group.add_argument('--shard-workers', help='Number of worker processes to start on this host with --coordinator', type=int, action='store', default=1)
+    threading_group.add_argument('--shard-size', help='Post ids per shard lease with --coordinator', type=int, action='store', default=10000)
+    threading_group.add_argument('--max-attempts', help='Attempts of a page or image before it goes into dead_letters.jsonl', type=int, action='store', default=5)
+    threading_group.add_argument('--index-rate', help='Index page requests per second, 0 for unlimited', type=float, action='store', default=10)
+    threading_group.add_argument('--image-rate', help='Image requests per second per host, 0 for unlimited', type=float, action='store', default=30)
+    threading_group.add_argument('--max-bandwidth', help='Image bytes per second in total, e.g. 2M, 0 for unlimited', type=byte_size, action='store', default=0)
+    threading_group.add_argument('--host-bandwidth', help='Image bytes per second per host, 0 for unlimited', type=byte_size, action='store', default=0)
+    threading_group.add_argument('--bandwidth-file', help='Reread the bandwidth caps from this file whenever it changes', action='store', default=False)
     etc_group = parser.add_argument_group('Extra')
+    etc_group.add_argument('--log-level', help='Only print messages of this level or above, warning for a quiet mode', choices=['debug', 'info', 'warning', 'error'], action='store', default='debug')
+    etc_group.add_argument('--metrics-format', help='Format of the stats file in storage', choices=['prometheus', 'json'], action='store', default='prometheus')
+    etc_group.add_argument('--metrics-interval', help='Seconds between stats file writes, 0 to disable', type=float, action='store', default=10)
+    etc_group.add_argument('--fsync-batch', help='Downloaded images fsynced at once, 0 to leave writing them back to the OS', type=int, action='store', default=64)
+    etc_group.add_argument('--no-preallocate', help='Do not reserve the disk space of an image before downloading it', action='store_true', default=False)
     etc_group.add_argument('-v', '--version', help='Show KonaDL version and exit', action='store_true', default=False)
-    return parser.parse_args()
+    args = parser.parse_args()
+    # Parsing again without defaults tells which options
+    # were actually given
+    for action in parser._actions:
+        action.default = argparse.SUPPRESS
+    args.given = set(vars(parser.parse_args()))
+    return args
 
 
 def check_storage_dir(args):
@@ -86,6 +133,43 @@ def check_storage_dir(args):
     return storage
 
 
+def human_size(size):
+    # Formats a byte count like 1.5 GiB
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024 or unit == 'GiB':
+            return '{} {}'.format(round(size, 1), unit)
+        size /= 1024
+
+
+def display_plan(plan):
+    """ Display the size of a crawl
+
+    Prints the images and bytes per rating that the crawl
+    would download, how much of it is new and how long
+    the crawl is projected to take.
+    """
+    avalon.info('{}{}{}{}{} page(s) planned'.format(avalon.FG.W, avalon.FM.BD, plan['pages'], avalon.FM.RST, avalon.FG.G))
+    for rating, counts in sorted(plan['ratings'].items()):
+        avalon.info('{}: {} image(s), {}, of which {} image(s), {} new'.format(
+            rating, counts['images'], human_size(counts['bytes']), counts['new_images'], human_size(counts['new_bytes'])))
+    total = plan['total']
+    avalon.info('Total: {}{}{} image(s), {}{}, of which {} image(s), {} new'.format(
+        avalon.FG.W, avalon.FM.BD, total['images'], human_size(total['bytes']), avalon.FM.RST,
+        total['new_images'], human_size(total['new_bytes'])))
+    if total['unknown_size']:
+        avalon.warning('The size of {} image(s) is unknown, use --source json to list file sizes'.format(total['unknown_size']))
+    if plan['failed_pages']:
+        avalon.warning('{} page(s) could not be fetched and are not counted'.format(plan['failed_pages']))
+    if plan['oversized']:
+        avalon.info('{} image(s) over the size limits skipped'.format(plan['oversized']))
+    if plan['projected_seconds'] is None:
+        avalon.info('Crawling the index took {} seconds, the downloads cannot be projected before a download rate and file sizes are known'.format(
+            plan['index_seconds']))
+    else:
+        avalon.info('Projected duration: {}{}{}{}{} seconds at {}/s'.format(
+            avalon.FG.W, avalon.FM.BD, plan['projected_seconds'], avalon.FM.RST, avalon.FG.G, human_size(plan['download_rate'])))
+
+
 def display_options(kona, load_progress, args):
     """ Display konadl crawling options
 
@@ -98,7 +182,7 @@ def display_options(kona, load_progress, args):
     """
     avalon.dbgInfo('Program Started')
     avalon.info('Using storage directory: {}{}'.format(avalon.FG.W, kona.storage))
-    if load_progress or args.update:
+    if load_progress or args.update or args.retry_failed:
         avalon.info('Sourcing configuration defined in the metadata file')
     else:
         if kona.safe:
@@ -109,6 +193,10 @@ def display_options(kona, load_progress, args):
             avalon.warning('Including {}EXPLICIT{} rated images'.format(avalon.FG.R, avalon.FG.Y))
         if kona.yandere:
             avalon.info('Crawling yande.re')
+        if kona.post_source == 'json':
+            avalon.info('Using the JSON API post source')
+        if kona.tags:
+            avalon.info('Only downloading posts tagged {}{}'.format(avalon.FG.W, kona.tags))
 
         if args.pages:
             if args.pages == 1:
@@ -119,9 +207,17 @@ def display_options(kona, load_progress, args):
             avalon.warning('Crawling {}ALL{} Pages\n'.format(avalon.FG.W, avalon.FG.Y))
         elif args.page:
             avalon.info('Crawling Page #{}'.format(args.page))
+        elif args.coordinator:
+            avalon.warning('Crawling {}ALL{} Pages, sharing shards through {}\n'.format(avalon.FG.W, avalon.FG.Y, args.coordinator))
 
     avalon.info('Opening {}{}{}{}{} crawler threads'.format(avalon.FG.W, avalon.FM.BD, args.crawlers, avalon.FM.RST, avalon.FG.G))
-    avalon.info('Opening {}{}{}{}{} downloader threads\n'.format(avalon.FG.W, avalon.FM.BD, args.downloaders, avalon.FM.RST, avalon.FG.G))
+    avalon.info('Opening {}{}{}{}{} downloader threads'.format(avalon.FG.W, avalon.FM.BD, args.downloaders, avalon.FM.RST, avalon.FG.G))
+    if kona.adaptive_concurrency:
+        avalon.info('Adapting to the server with up to {}{}{}{}{} crawler and {}{}{}{}{} downloader threads\n'.format(
+            avalon.FG.W, avalon.FM.BD, kona.crawler_thread_count(), avalon.FM.RST, avalon.FG.G,
+            avalon.FG.W, avalon.FM.BD, kona.downloader_thread_count(), avalon.FM.RST, avalon.FG.G))
+    else:
+        print()
 
 
 class konadl_avalon(konadl):
@@ -193,10 +289,33 @@ try:
             avalon.error('Please specify storage directory\n')
             exit(1)
 
+        kona.use_index = not args.no_index
+        kona.use_page_cache = not args.no_page_cache
+        if args.import_index:
+            avalon.info('Importing images in {}{}{} into the download index'.format(avalon.FG.W, avalon.FM.BD, kona.storage))
+            imported = kona.import_storage()
+            avalon.info('{}{}{}{}{} image(s) recorded\n'.format(avalon.FG.W, avalon.FM.BD, imported, avalon.FM.RST, avalon.FG.G))
+            exit(0)
+
+        kona.fsync_batch = args.fsync_batch
+        kona.preallocate = not args.no_preallocate
+        if args.migrate_layout:
+            avalon.info('Moving the images in {}{}{} into the {} layout'.format(avalon.FG.W, avalon.FM.BD, kona.storage, args.migrate_layout))
+            moved = kona.migrate_layout(args.migrate_layout)
+            avalon.info('{}{}{}{}{} image(s) moved\n'.format(avalon.FG.W, avalon.FM.BD, moved, avalon.FM.RST, avalon.FG.G))
+            exit(0)
+        if args.layout:
+            # Mixing layouts would hide images from each other
+            stored_layout = kona.read_layout()
+            if stored_layout and stored_layout[0] != args.layout:
+                avalon.error('Storage uses the {} layout, move it with --migrate-layout {}\n'.format(stored_layout[0], args.layout))
+                exit(1)
+            kona.layout = args.layout
+
         # If progress file exists
         # Ask user if he or she wants to load it
         load_progress = False
-        if kona.progress_files_present():
+        if not args.coordinator and not args.plan and kona.progress_files_present():
             avalon.info('Progress file found')
             if avalon.ask('Continue from where you left off?', True):
                 kona.load_progress = True
@@ -207,15 +326,43 @@ try:
 
         # Pass terminal arguments to libkonadl object
         kona.separate = args.separate
+        kona.content_addressed = args.content_addressed
+        kona.archive_format = args.archive
+        kona.archive_size = args.archive_size
         kona.yandere = args.yandere
+        kona.post_source = args.source
+        kona.tags = args.tags
+        kona.variant = args.variant
+        kona.min_resolution = args.min_resolution
+        kona.max_file_size = args.max_file_size
+        kona.max_resolution = args.max_resolution
         kona.safe = args.safe
         kona.questionable = args.questionable
         kona.explicit = args.explicit
         kona.post_crawler_threads_amount = args.crawlers
         kona.downloader_threads_amount = args.downloaders
+        kona.max_post_crawler_threads = args.max_crawlers
+        kona.max_downloader_threads = args.max_downloaders
+        kona.adaptive_concurrency = not args.fixed_threads
+        kona.shard_size = args.shard_size
+        kona.max_attempts = args.max_attempts
+        kona.index_rate = args.index_rate
+        kona.image_rate = args.image_rate
+        kona.max_bandwidth = args.max_bandwidth
+        kona.host_bandwidth = args.host_bandwidth
+        kona.bandwidth_file = args.bandwidth_file
+        kona.log_level = getattr(logging, args.log_level.upper())
+        kona.metrics_format = args.metrics_format
+        kona.metrics_interval = args.metrics_interval
+        # Options given win over the ones stored in the metadata
+        # file, as far as the stored search allows
+        kona.pinned_options = {option for argument, option in PINNED_OPTIONS.items() if argument in args.given}
         display_options(kona, load_progress, args)
 
-        if not kona.safe and not kona.questionable and not kona.explicit and not load_progress and not args.update:
+        if args.archive and args.content_addressed:
+            avalon.error('--archive and --content-addressed cannot be combined\n')
+            exit(1)
+        if not kona.safe and not kona.questionable and not kona.explicit and not load_progress and not args.update and not args.retry_failed:
             avalon.error('Please supply information about what you want to download')
             print(avalon.FM.BD + 'You must include one of the following arguments:')
             print('  -s, --safe            Include Safe rated images')
@@ -223,7 +370,7 @@ try:
             print('  -e, --explicit        Include Explicit rated images')
             print('Use --help for more information\n' + avalon.FM.RST)
             exit(1)
-        elif not args.pages and not args.all and not args.page and not load_progress and not args.update:
+        elif not args.pages and not args.all and not args.page and not load_progress and not args.update and not args.coordinator and not args.retry_failed:
             avalon.error('Please supply information about what you want to download')
             print(avalon.FM.BD + 'You must include one of the following arguments:')
             print('  -n PAGES, --pages PAGES')
@@ -232,8 +379,21 @@ try:
             print('  -p PAGE, --page PAGE  Crawl a specific page')
             print('Use --help for more information\n' + avalon.FM.RST)
 
-        if load_progress:
+        if args.plan:
+            if args.pages:
+                kona.pages = args.pages
+            elif args.all:
+                kona.crawl_all = True
+            elif args.page:
+                kona.first_page = kona.pages = args.page
+            display_plan(kona.plan())
+            exit(0)
+        elif load_progress:
             kona.crawl()
+        elif args.retry_failed:
+            avalon.info('Retrying failed jobs')
+            if kona.retry_failed() is False:
+                avalon.info('{}{}No failed jobs to retry\n'.format(avalon.FM.BD, avalon.FG.W))
         elif args.update:
             avalon.info('Updating new images')
             if kona.update() is False:
@@ -245,11 +405,28 @@ try:
             kona.crawl_all_pages()
         elif args.page:
             kona.crawl_page(args.page)
+        elif args.coordinator:
+            # The other workers on this host are copies of this
+            # program, each claiming shards on its own
+            workers = []
+            for _ in range(args.shard_workers - 1):
+                workers.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ['--shard-workers', '1']))
+            kona.crawl_shards(args.coordinator)
+            for worker in workers:
+                worker.wait()
 
         avalon.info('Main thread exited without errors')
         avalon.info('{}{}{}{}{} image(s) downloaded'.format(avalon.FG.W, avalon.FM.BD, kona.total_downloads, avalon.FM.RST, avalon.FG.G))
         avalon.info('Time taken: {}{}{}{}{} seconds'.format(avalon.FG.W, avalon.FM.BD, round(
             (time.time() - kona.begin_time + kona.time_elapsed), 5), avalon.FM.RST, avalon.FG.G))
+        if kona.sessions:
+            for host, stats in kona.sessions.stats().items():
+                avalon.dbgInfo('{}: {} requests, {} reused connections, {} new connections'.format(
+                    host, stats['requests'], stats['hits'], stats['misses']))
+        if kona.limiter:
+            for budget, stats in kona.limiter.stats().items():
+                avalon.dbgInfo('{}: {} requests/s, throttled for {} seconds, {} 429/5xx responses'.format(
+                    budget, stats['rate'], stats['throttled_time'], stats['throttled_responses']))
         if kona.job_done:
             avalon.info('All downloads complete')
             if kona.progress_files_present():
@@ -22,31 +22,1900 @@ Description: Konachan downloader is a simple python
 script / library that will help you download
 konachan.com / konachan.net images.
 """
-from bs4 import BeautifulSoup
+import bisect
+import collections
 import configparser
 import datetime
+import email.utils
+import hashlib
+import heapq
+import html
+import json
+import logging
+import math
 import os
 import queue
+import random
+import re
 import requests
+import shutil
+import socket
+import sqlite3
+import sys
+import tarfile
+import tempfile
 import threading
 import time
 import traceback
+import urllib.parse
+import zipfile
+
+RATINGS = {'s': 'safe', 'q': 'questionable', 'e': 'explicit'}
+LOG_LEVELS = {'print_retrieval': logging.DEBUG,
+              'print_thread_exit': logging.DEBUG,
+              'print_crawling_page': logging.INFO,
+              'print_saving_progress': logging.INFO,
+              'print_loading_progress': logging.INFO,
+              'warn_keyboard_interrupt': logging.WARNING,
+              'warn_stored_option': logging.WARNING,
+              'print_429': logging.WARNING,
+              'print_exception': logging.ERROR,
+              'print_faulty_progress_file': logging.ERROR}
+POST_LIST_PATTERN = re.compile(r'<ul\s[^>]*\bid=["\']post-list-posts["\'][^>]*>', re.IGNORECASE)
+POST_TAG_PATTERN = re.compile(r'<(li|img|a)\s([^>]*)>', re.IGNORECASE)
+ATTRIBUTE_PATTERN = re.compile(r'([\w-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+PAGINATION_PATTERN = re.compile(r'<div\s[^>]*\bclass=["\']pagination["\'][^>]*>(.*?)</div>', re.IGNORECASE | re.DOTALL)
+PAGE_NUMBER_PATTERN = re.compile(r'>\s*(\d+)\s*<')
+IMAGE_MD5_PATTERN = re.compile(r'/(image|jpeg|sample)/([0-9a-f]{32})/')
+FILE_NAME_ID_PATTERN = re.compile(r'\D*?(\d+)')
+POST_REGISTER_PATTERN = re.compile(r'Post\.register(_resp)?\((\{.*\})\)\s*;?\s*$', re.MULTILINE)
+VARIANTS = ['original', 'jpeg', 'sample']
+LAYOUTS = ['flat', 'md5', 'id']
+VARIANT_FIELDS = {'original': ('file_url', 'file_size', 'width', 'height'),
+                  'jpeg': ('jpeg_url', 'jpeg_file_size', 'jpeg_width', 'jpeg_height'),
+                  'sample': ('sample_url', 'sample_file_size', 'sample_width', 'sample_height')}
 
 
 def print_locker(function):
-    """ Prevents printing formating error
+    """ Hands a print hook to the log writer
 
-    Prevents other threads from printing when
-    current thread is printing.
+    The hook runs on the background log writer thread
+    instead of the calling thread, so messages never
+    interleave and workers never wait on the terminal.
+    Hooks below the log level (see LOG_LEVELS) are
+    dropped before anything is queued.
     """
+    level = LOG_LEVELS.get(function.__name__, logging.INFO)
 
     def wrapper(*args):
-        args[0].print_lock.acquire()
-        function(*args)
-        args[0].print_lock.release()
+        if level >= args[0].log_level:
+            args[0].log_writer.submit(function, *args)
     return wrapper
 
 
+class log_writer:
+    """ Background log writer
+
+    Print hooks and error log entries are queued by the
+    crawler and downloader threads and run one after
+    another by a single background thread. Log files stay
+    open between entries.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def submit(self, function, *args):
+        # Queues function(*args), starting the writer if needed
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.write_worker, daemon=True)
+                    self.thread.name = 'Log Writer'
+                    self.thread.start()
+        self.queue.put((function, args))
+
+    def write_worker(self):
+        while True:
+            function, args = self.queue.get()
+            try:
+                function(*args)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    def append(self, file_path, text):
+        # Runs on the writer thread, see submit
+        if file_path not in self.files:
+            self.files[file_path] = open(file_path, 'a+')
+        self.files[file_path].write(text)
+
+    def close_files(self):
+        for log_file in self.files.values():
+            log_file.close()
+        self.files = {}
+
+    def flush(self):
+        """ Waits for the queued entries
+
+        Returns once everything queued so far is written
+        and the log files are closed.
+        """
+        if self.thread is None:
+            return
+        self.submit(self.close_files)
+        self.queue.join()
+
+
+class session_pool:
+    """ Pooled HTTP sessions
+
+    Keeps one keep-alive requests session per host so that
+    index pages and images reuse established TCP/TLS
+    connections instead of handshaking for every request.
+    Konachan, yande.re and their CDN hosts each get their
+    own connection pool.
+    """
+
+    def __init__(self, pool_size, headers):
+        self.pool_size = pool_size
+        self.headers = headers
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def session(self, url):
+        # Returns the session of the host that serves url
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                session.headers.update(self.headers)
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    def get(self, url, **kwargs):
+        return self.session(url).get(url, **kwargs)
+
+    def stats(self):
+        """ Connection pool statistics
+
+        Returns a dictionary of hosts with the amount of
+        requests sent, connections opened (pool misses) and
+        requests served by an existing connection (pool hits).
+        """
+        stats = {}
+        with self.lock:
+            sessions = dict(self.sessions)
+        for host, session in sessions.items():
+            requests_sent = 0
+            connections = 0
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is None:
+                        continue
+                    requests_sent += pool.num_requests
+                    connections += pool.num_connections
+            stats[host] = {'requests': requests_sent,
+                           'hits': requests_sent - connections,
+                           'misses': connections}
+        return stats
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+class token_bucket:
+    """ Token bucket
+
+    Hands out "rate" tokens per second with bursts of up
+    to "capacity" tokens. A rate of 0 means unlimited.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount=1):
+        # Blocks until amount tokens are available
+        while True:
+            with self.lock:
+                if not self.rate:
+                    return
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def reserve(self, amount):
+        """ Takes tokens in advance
+
+        Takes amount tokens right away, running into debt if
+        there are not enough, and returns the seconds until
+        the debt is paid off. Callers waiting that long are
+        served first come first served, each at their share
+        of the rate, instead of racing for freed tokens.
+        """
+        with self.lock:
+            if not self.rate:
+                return 0
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return max(0, -self.tokens / self.rate)
+
+    def set_rate(self, rate, capacity=None):
+        # Changes the rate, keeping the tokens gathered so far
+        with self.lock:
+            now = time.monotonic()
+            if self.rate:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.rate = rate
+            self.capacity = capacity or max(rate, 1)
+            self.tokens = min(self.tokens, self.capacity)
+
+
+class rate_limiter:
+    """ Shared request rate limiter
+
+    Shared by all crawler and downloader threads. Index
+    pages and every image host have their own token
+    bucket. A 429 or 5xx response blocks its budget for
+    the time the server asks for in Retry-After, or an
+    exponentially growing delay with jitter, and halves
+    its rate. Every successful request wins back a
+    little of the configured rate.
+    """
+
+    def __init__(self, index_rate, image_rate, backoff_base=1, backoff_max=300):
+        self.index_rate = index_rate
+        self.image_rate = image_rate
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.budgets = {}
+        self.lock = threading.Lock()
+
+    def budget(self, name):
+        with self.lock:
+            if name not in self.budgets:
+                rate = self.index_rate if name == 'index' else self.image_rate
+                self.budgets[name] = {'bucket': token_bucket(rate),
+                                      'configured_rate': rate,
+                                      'blocked_until': 0,
+                                      'strikes': 0,
+                                      'throttled_time': 0,
+                                      'throttled_responses': 0}
+            return self.budgets[name]
+
+    def acquire(self, name):
+        # Waits until a request may be sent on this budget
+        budget = self.budget(name)
+        start = time.monotonic()
+        while True:
+            wait = budget['blocked_until'] - time.monotonic()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+        budget['bucket'].consume()
+        waited = time.monotonic() - start
+        if waited > 0.001:
+            with self.lock:
+                budget['throttled_time'] += waited
+
+    def penalize(self, name, retry_after=None):
+        # Backs off after the server refused a request
+        budget = self.budget(name)
+        with self.lock:
+            budget['strikes'] += 1
+            budget['throttled_responses'] += 1
+            delay = min(self.backoff_max, self.backoff_base * 2 ** (budget['strikes'] - 1))
+            delay *= random.uniform(0.5, 1.5)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            budget['blocked_until'] = max(budget['blocked_until'], time.monotonic() + delay)
+            bucket = budget['bucket']
+            if bucket.rate:
+                bucket.rate = max(budget['configured_rate'] / 20, bucket.rate / 2)
+
+    def reward(self, name):
+        # Recovers the rate after a successful request
+        budget = self.budget(name)
+        with self.lock:
+            budget['strikes'] = 0
+            bucket = budget['bucket']
+            if bucket.rate:
+                bucket.rate = min(budget['configured_rate'], bucket.rate + budget['configured_rate'] / 20)
+
+    def stats(self):
+        """ Rate limiter statistics
+
+        Returns every budget's current rate (requests per
+        second, 0 is unlimited), the seconds requests spent
+        waiting for it and the amount of 429/5xx responses.
+        """
+        with self.lock:
+            return {name: {'rate': round(budget['bucket'].rate, 3),
+                           'throttled_time': round(budget['throttled_time'], 3),
+                           'throttled_responses': budget['throttled_responses']}
+                    for name, budget in self.budgets.items()}
+
+
+class bandwidth_limiter:
+    """ Shared download bandwidth limiter
+
+    Caps the bytes per second read off of image responses,
+    in total and per host. Downloaders take their bytes
+    from both token buckets a chunk at a time, in the
+    order they ask for them, so every downloader gets an
+    equal share. A rate of 0 means unlimited. Rates can
+    be changed with set_rates while downloading.
+
+    Bursts are kept to a tenth of a second worth of bytes
+    so the first downloader cannot take a second's worth
+    before the others start.
+    """
+    BURST = 0.1
+
+    def __init__(self, total_rate=0, host_rate=0):
+        self.total = token_bucket(total_rate, total_rate * self.BURST)
+        self.host_rate = host_rate
+        self.hosts = {}
+        self.throttled_time = {'total': 0}
+        self.lock = threading.Lock()
+
+    def host_bucket(self, host):
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = token_bucket(self.host_rate, self.host_rate * self.BURST)
+                self.throttled_time[host] = 0
+            return self.hosts[host]
+
+    def consume(self, host, amount):
+        # Waits until amount bytes from host may be read
+        host_wait = self.host_bucket(host).reserve(amount)
+        total_wait = self.total.reserve(amount)
+        wait = max(host_wait, total_wait)
+        if wait > 0:
+            time.sleep(wait)
+            with self.lock:
+                self.throttled_time[host] += host_wait
+                self.throttled_time['total'] += total_wait
+        return wait
+
+    def set_rates(self, total_rate, host_rate):
+        # Applies new caps to the running downloads
+        self.total.set_rate(total_rate, total_rate * self.BURST)
+        with self.lock:
+            self.host_rate = host_rate
+            buckets = list(self.hosts.values())
+        for bucket in buckets:
+            bucket.set_rate(host_rate, host_rate * self.BURST)
+
+    def stats(self):
+        """ Bandwidth limiter statistics
+
+        Returns the cap (bytes per second, 0 is unlimited)
+        and the seconds downloads spent waiting for it, in
+        total and for every host.
+        """
+        with self.lock:
+            stats = {'total': {'rate': self.total.rate, 'throttled_time': round(self.throttled_time['total'], 3)}}
+            for host, bucket in self.hosts.items():
+                stats[host] = {'rate': bucket.rate, 'throttled_time': round(self.throttled_time[host], 3)}
+            return stats
+
+
+def byte_size(size):
+    """ Reads a byte count such as "512K" or "2.5M"
+
+    The suffixes K, M and G (case insensitive, with an
+    optional trailing "B") are powers of 1024.
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmg]?)b?\s*$', str(size), re.IGNORECASE)
+    if match is None:
+        raise ValueError('Invalid byte size: {}'.format(size))
+    return int(float(match.group(1)) * 1024 ** ' kmg'.index(match.group(2).lower() or ' '))
+
+
+def put_unless_stopped(target_queue, item, stop):
+    # Puts item into a bounded queue unless stop is set
+    # while waiting for room, returns True if it was put
+    while not stop.is_set():
+        try:
+            target_queue.put(item, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def backoff_delay(attempts, backoff_base, backoff_max):
+    # Seconds to wait after a job failed this many times,
+    # doubled for every attempt with jitter against bursts
+    return min(backoff_max, backoff_base * 2 ** (attempts - 1)) * random.uniform(0.5, 1.5)
+
+
+def retry_after_seconds(retry_after):
+    """ Parses a Retry-After header
+
+    The header holds either a number of seconds or an
+    HTTP date. Returns None if it is missing or invalid.
+    """
+    if not retry_after:
+        return None
+    if retry_after.strip().isdigit():
+        return int(retry_after)
+    try:
+        retry_time = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0, (retry_time - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class html_post_source:
+    """ HTML post source
+
+    Scrapes the regular /post?page=N index pages. This
+    is what the website shows in a browser and yields
+    one page of thumbnails (20 to 40 posts) per request.
+    """
+
+    name = 'html'
+
+    def __init__(self, site_root):
+        self.site_root = site_root
+
+    def absolute_url(self, url):
+        # Image links can be protocol or site relative
+        if url.startswith('//'):
+            return '{}:{}'.format(urllib.parse.urlsplit(self.site_root).scheme, url)
+        elif url.startswith('/'):
+            return '{}{}'.format(self.site_root, url)
+        return url
+
+    def page_url(self, page, tags=''):
+        return '{}/post?page={}&tags={}'.format(self.site_root, page, urllib.parse.quote_plus(tags))
+
+    def total_pages_url(self, tags=''):
+        return self.page_url(1, tags)
+
+    def parse_total_pages(self, page_source):
+        return extract_total_pages(page_source.text)
+
+    def parse_index(self, page_source):
+        # Everything an index page tells, as cached by fetch_index
+        return {'posts': self.parse_posts(page_source), 'total_pages': self.parse_total_pages(page_source)}
+
+    def parse_posts(self, page_source):
+        """ Parse posts off of an index page
+
+        Returns a list of post dictionaries containing the
+        post id, the rating and the large image url, plus
+        the variants the page registers for the post.
+        """
+        registered = extract_post_register(page_source.text)
+        posts = []
+        for post in extract_posts(page_source.text):
+            # Posts without a direct link have no image to download
+            if post['url'] is not None:
+                post['url'] = self.absolute_url(post['url'])
+                if post['id'] in registered:
+                    post['variants'] = self.variants(registered[post['id']])
+                posts.append(post)
+        return posts
+
+    def variants(self, data):
+        # Files of a post with their size and resolution, where known
+        variants = post_variants(data)
+        for variant in variants:
+            variant['url'] = self.absolute_url(variant['url'])
+        return variants
+
+
+class json_post_source(html_post_source):
+    """ JSON API post source
+
+    Uses the Moebooru /post.json API, which returns up to
+    1000 posts per request as plain JSON instead of HTML
+    that has to be parsed.
+    """
+
+    name = 'json'
+    posts_per_page = 1000
+
+    def page_url(self, page, tags=''):
+        return '{}/post.json?page={}&limit={}&tags={}'.format(
+            self.site_root, page, self.posts_per_page, urllib.parse.quote_plus(tags))
+
+    def total_pages_url(self, tags=''):
+        # post.xml is the only listing that carries the post count
+        return '{}/post.xml?limit=1&tags={}'.format(self.site_root, urllib.parse.quote_plus(tags))
+
+    def parse_total_pages(self, page_source):
+        count = int(re.search(r'<posts[^>]*count="(\d+)"', page_source.text).group(1))
+        return math.ceil(count / self.posts_per_page)
+
+    def parse_index(self, page_source):
+        if urllib.parse.urlsplit(page_source.url).path.endswith('.xml'):
+            return {'total_pages': self.parse_total_pages(page_source)}
+        return {'posts': self.parse_posts(page_source)}
+
+    def parse_posts(self, page_source):
+        posts = []
+        for post in page_source.json():
+            # Posts without a file have no image to download
+            if not post.get('file_url'):
+                continue
+            posts.append({'id': int(post['id']),
+                          'rating': RATINGS.get(post['rating'], False),
+                          'url': self.absolute_url(post['file_url']),
+                          'variants': self.variants(post)})
+        return posts
+
+
+POST_SOURCES = {'html': html_post_source, 'json': json_post_source}
+
+
+def tag_attributes(attributes):
+    # Parses the attribute string of a single tag into a dictionary
+    return {match.group(1).lower(): html.unescape(match.group(2) if match.group(2) is not None else match.group(3))
+            for match in ATTRIBUTE_PATTERN.finditer(attributes)}
+
+
+def alt_rating(alt):
+    # Reads the rating off of a thumbnail's alt text
+    if 'Rating: Safe' in alt:
+        return 'safe'
+    elif 'Rating: Questionable' in alt:
+        return 'questionable'
+    elif 'Rating: Explicit' in alt:
+        return 'explicit'
+    return False
+
+
+def extract_posts(page_text):
+    """ Extracts posts from an index page
+
+    Scans only the <li>, <img> and <a> tags inside
+    ul#post-list-posts instead of building a tree of the
+    whole document. For every post the id, the rating in
+    the alt text of the first image and the href of the
+    a.directlink are read, everything else is skipped.
+    Queries matching nothing get a page without the post
+    list, which has no posts.
+    """
+    post_list = POST_LIST_PATTERN.search(page_text)
+    if post_list is None:
+        return []
+    end = page_text.find('</ul>', post_list.end())
+    if end == -1:
+        end = len(page_text)
+
+    posts = []
+    post = None
+    for tag in POST_TAG_PATTERN.finditer(page_text, post_list.end(), end):
+        name = tag.group(1).lower()
+        if name == 'li':
+            post = {'id': post_id_number(tag_attributes(tag.group(2))['id']),
+                    'rating': None,
+                    'url': None}
+            posts.append(post)
+        elif post is None:
+            continue
+        elif name == 'img' and post['rating'] is None:
+            attributes = tag_attributes(tag.group(2))
+            if 'alt' in attributes:
+                post['rating'] = alt_rating(attributes['alt'])
+        elif name == 'a' and post['url'] is None and 'directlink' in tag.group(2):
+            attributes = tag_attributes(tag.group(2))
+            if 'directlink' in attributes.get('class', '').split():
+                post['url'] = attributes['href']
+    return posts
+
+
+def extract_post_register(page_text):
+    """ Extracts the post data registered by an index page
+
+    Index pages hand every post to their scripts through
+    Post.register({...}) calls, one per line, or a single
+    Post.register_resp({"posts": [...]}) call. Returns the
+    JSON data of the posts keyed by post id.
+    """
+    registered = {}
+    for match in POST_REGISTER_PATTERN.finditer(page_text):
+        try:
+            data = json.loads(match.group(2))
+        except ValueError:
+            continue
+        for post in data.get('posts', []) if match.group(1) else [data]:
+            if 'id' in post:
+                registered[int(post['id'])] = post
+    return registered
+
+
+def post_variants(data):
+    """ Lists the files a post can be downloaded as
+
+    Moebooru serves every post as the original file, as
+    a JPEG of the original and as a smaller sample. Posts
+    without a separate JPEG or sample point those urls at
+    the original, so they inherit its size and resolution.
+    Sizes and resolutions the site leaves out are None.
+    """
+    variants = []
+    for name in VARIANTS:
+        url_field, size_field, width_field, height_field = VARIANT_FIELDS[name]
+        if not data.get(url_field):
+            continue
+        variant = {'name': name,
+                   'url': data[url_field],
+                   'size': data.get(size_field) or None,
+                   'width': data.get(width_field) or None,
+                   'height': data.get(height_field) or None}
+        if variants and variant['url'] == variants[0]['url']:
+            variant.update({key: variants[0][key] for key in ('size', 'width', 'height')})
+        variants.append(variant)
+    return variants
+
+
+def variant_long_side(variant):
+    # Long side of a variant in pixels, 0 if unknown
+    return max(variant['width'] or 0, variant['height'] or 0)
+
+
+def extract_total_pages(page_text):
+    """ Extracts the number of the last page
+
+    Reads the largest page number in the pagination bar
+    of an index page. Pages without pagination bar only
+    have a single page.
+    """
+    pagination = PAGINATION_PATTERN.search(page_text)
+    if pagination is None:
+        return 1
+    return max([int(number) for number in PAGE_NUMBER_PATTERN.findall(pagination.group(1))], default=1)
+
+
+def image_url_md5(url):
+    # Image urls contain the md5 of the image, e.g. /image/<md5>/...
+    match = IMAGE_MD5_PATTERN.search(url)
+    if match is None:
+        return None
+    return match.group(2)
+
+
+def image_url_variant(url):
+    # "image" for the original file, "jpeg" or "sample"
+    match = IMAGE_MD5_PATTERN.search(url)
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def response_image_length(response):
+    # Length of the whole image a response carries, None if
+    # not told; 206 responses give it in Content-Range
+    if response.status_code == 206:
+        content_range = re.match(r'bytes \d+-\d+/(\d+)', response.headers.get('content-range', ''))
+        return int(content_range.group(1)) if content_range else None
+    content_length = response.headers.get('content-length')
+    return int(content_length) if content_length is not None else None
+
+
+def url_file_name(url):
+    # "Konachan.com%20-%20123%20tags.png" is saved as "Konachan.com_123_tags.png"
+    return url.split("/")[-1].replace('%20', '_').replace('_-_', '_')
+
+
+def file_name_post_id(file_name):
+    """ Reads the post id off of an image file name
+
+    Image file names start with the site name followed
+    by the post id, e.g. "Konachan.com - 123456 tags.png"
+    or "yande.re 123456 tags.png", either url quoted or
+    with spaces replaced by underscores.
+    """
+    match = FILE_NAME_ID_PATTERN.match(urllib.parse.unquote(file_name))
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def file_name_site(file_name):
+    # Tells which site an image file name belongs to
+    if file_name.lower().startswith('yande.re'):
+        return 'yande.re'
+    return 'konachan.com'
+
+
+def file_md5(file_path):
+    # Computes the md5 of a file without loading it into memory
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def layout_folder(file_name, layout, id_folder_size=10000):
+    """ Folder of an image file in a storage layout
+
+    "flat" keeps every image in one folder. "md5" spreads
+    them over 65536 folders named after the md5 of the
+    file name, e.g. "3f/a2/", so nothing but the name is
+    needed to find a file again. "id" groups posts by
+    id, e.g. "120000-129999/", so neighbouring posts
+    share a folder. Returns the folder relative to the
+    rating folder, '' for the top one.
+    """
+    if layout == 'md5':
+        name_md5 = hashlib.md5(file_name.encode()).hexdigest()
+        return '{}/{}/'.format(name_md5[0:2], name_md5[2:4])
+    if layout == 'id':
+        post_id = file_name_post_id(file_name)
+        if post_id is not None:
+            first_id = post_id // id_folder_size * id_folder_size
+            return '{}-{}/'.format(first_id, first_id + id_folder_size - 1)
+    return ''
+
+
+def fsync_path(path):
+    # fsyncs a file or folder by its path; folders cannot
+    # be opened on Windows and files may be gone already
+    try:
+        descriptor = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
+
+
+def archive_entries(sidecar_file):
+    # Yields the entries of an archive shard's sidecar
+    # index, stopping at a line torn by a crash
+    with open(sidecar_file, 'r') as sidecar:
+        for line in sidecar:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                break
+
+
+def post_id_number(post_id):
+    """ Converts a post id into an integer
+
+    The HTML index prefixes post ids with "p" (e.g. "p12345"),
+    which is also how older metadata files stored them.
+    Returns False if there is no post id.
+    """
+    post_id = str(post_id).strip()
+    if post_id in ('', 'False', 'None'):
+        return False
+    return int(post_id.lstrip('p'))
+
+
+def set_journal_mode(connection, shared):
+    # WAL for a database used on this host only, a rollback
+    # journal with full syncs for one shared over the network
+    if shared:
+        connection.execute('PRAGMA journal_mode=DELETE')
+        connection.execute('PRAGMA synchronous=FULL')
+    else:
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+
+
+class download_index:
+    """ Local index of downloaded posts
+
+    A SQLite database in the storage directory that
+    records every downloaded post by site and post id,
+    along with its md5, file name, size and rating. The
+    crawlers look posts up here before queuing them, so
+    posts already in storage are never downloaded twice.
+
+    WAL needs memory shared between the processes using
+    the database, so an index shared over the network
+    ("shared") uses a rollback journal instead.
+    """
+
+    def __init__(self, index_file, shared=False):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(index_file, timeout=60, check_same_thread=False)
+        with self.lock:
+            set_journal_mode(self.connection, shared)
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS posts (
+                                        site TEXT NOT NULL,
+                                        id INTEGER NOT NULL,
+                                        md5 TEXT,
+                                        file_name TEXT,
+                                        size INTEGER,
+                                        rating TEXT,
+                                        timestamp REAL,
+                                        archive TEXT,
+                                        archive_offset INTEGER,
+                                        PRIMARY KEY (site, id))""")
+            # Indexes from before archive shards lack their columns
+            columns = [column[1] for column in self.connection.execute('PRAGMA table_info(posts)')]
+            if 'archive' not in columns:
+                self.connection.execute('ALTER TABLE posts ADD COLUMN archive TEXT')
+                self.connection.execute('ALTER TABLE posts ADD COLUMN archive_offset INTEGER')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS posts_md5 ON posts (md5)')
+            self.connection.commit()
+
+    def has_post(self, site, post_id):
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM posts WHERE site = ? AND id = ?',
+                                           (site, post_id)).fetchone() is not None
+
+    def find_md5(self, md5):
+        # Returns (site, id, file_name) of a post with this md5, or None
+        with self.lock:
+            return self.connection.execute('SELECT site, id, file_name FROM posts WHERE md5 = ?',
+                                           (md5,)).fetchone()
+
+    def find_archived(self, site, post_id):
+        # Returns (archive, archive_offset, size) of a post
+        # packed into an archive shard, None otherwise
+        with self.lock:
+            return self.connection.execute('SELECT archive, archive_offset, size FROM posts '
+                                           'WHERE site = ? AND id = ? AND archive IS NOT NULL',
+                                           (site, post_id)).fetchone()
+
+    def add(self, site, post_id, md5, file_name, size, rating, timestamp=None, archive=None, archive_offset=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO posts (site, id, md5, file_name, size, rating, timestamp, '
+                                    'archive, archive_offset) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (site, post_id, md5, file_name, size, rating, timestamp, archive, archive_offset))
+            self.connection.commit()
+
+    def move(self, site, post_id, old_file_name, file_name):
+        # Records the new path of a post moved in storage
+        with self.lock:
+            self.connection.execute('UPDATE posts SET file_name = ? WHERE site = ? AND id = ? AND file_name = ?',
+                                    (file_name, site, post_id, old_file_name))
+            self.connection.commit()
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM posts').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class page_cache:
+    """ Conditional request cache for index pages
+
+    A SQLite database in the storage directory keeping
+    the ETag / Last-Modified validators of index pages
+    along with what was parsed off of them, so a page the
+    server reports unchanged (304) is neither downloaded
+    nor parsed again. Like the download index it uses a
+    rollback journal when "shared" over the network.
+
+    Pages not fetched or revalidated for max_age seconds
+    are pruned when the cache is opened, and only the
+    max_pages most recent ones are kept, so the file
+    stops growing; SQLite reuses the freed space. 0
+    turns either bound off.
+    """
+
+    def __init__(self, cache_file, shared=False, max_age=30 * 86400, max_pages=10000):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(cache_file, timeout=60, check_same_thread=False)
+        with self.lock:
+            set_journal_mode(self.connection, shared)
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS pages (
+                                        url TEXT PRIMARY KEY,
+                                        etag TEXT,
+                                        last_modified TEXT,
+                                        result TEXT,
+                                        timestamp REAL)""")
+            self.connection.execute('CREATE INDEX IF NOT EXISTS pages_timestamp ON pages (timestamp)')
+            if max_age:
+                self.connection.execute('DELETE FROM pages WHERE timestamp < ?', (time.time() - max_age,))
+            if max_pages:
+                self.connection.execute("""DELETE FROM pages WHERE url NOT IN (
+                                            SELECT url FROM pages ORDER BY timestamp DESC LIMIT ?)""", (max_pages,))
+            self.connection.commit()
+
+    def get(self, url):
+        # Returns (etag, last_modified, result) or None
+        with self.lock:
+            page = self.connection.execute('SELECT etag, last_modified, result FROM pages WHERE url = ?',
+                                           (url,)).fetchone()
+        if page is None:
+            return None
+        return page[0], page[1], json.loads(page[2])
+
+    def put(self, url, etag, last_modified, result):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)',
+                                    (url, etag, last_modified, json.dumps(result), time.time()))
+            self.connection.commit()
+
+    def touch(self, url):
+        # A page the server reported unchanged is fresh again
+        with self.lock:
+            self.connection.execute('UPDATE pages SET timestamp = ? WHERE url = ?', (time.time(), url))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class lease_coordinator:
+    """ Shard leases shared by worker processes
+
+    A SQLite database on storage shared by every worker
+    process, on this host or others, that splits the
+    site into shards of consecutive post ids. A worker
+    claims a shard by taking its lease, renews the lease
+    while crawling and marks the shard done afterwards.
+    The lease of a worker that died expires and its
+    shard is claimed by the next worker looking for work.
+    Workers on other hosts reach the database over the
+    network, where WAL does not work, so it always uses
+    a rollback journal.
+    """
+
+    def __init__(self, coordinator_file, lease_time=120):
+        self.lease_time = lease_time
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(coordinator_file, timeout=60, check_same_thread=False,
+                                          isolation_level=None)
+        with self.lock:
+            set_journal_mode(self.connection, True)
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS shards (
+                                        shard INTEGER PRIMARY KEY,
+                                        first_id INTEGER NOT NULL,
+                                        last_id INTEGER NOT NULL,
+                                        owner TEXT,
+                                        expires REAL NOT NULL DEFAULT 0,
+                                        done INTEGER NOT NULL DEFAULT 0)""")
+
+    def plan(self, newest_id, shard_size):
+        """ Splits post ids 1 to newest_id into shards
+
+        Only the first worker plans, the others find the
+        shards already there. Newer posts come first.
+        Returns the number of shards.
+        """
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                shards = self.connection.execute('SELECT COUNT(*) FROM shards').fetchone()[0]
+                if not shards:
+                    # A site without posts has no shards
+                    for last_id in range(newest_id or 0, 0, -shard_size):
+                        self.connection.execute('INSERT INTO shards (first_id, last_id) VALUES (?, ?)',
+                                                (max(1, last_id - shard_size + 1), last_id))
+                        shards += 1
+                self.connection.execute('COMMIT')
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+            return shards
+
+    def claim(self, owner):
+        # Leases the next free or expired shard to owner
+        # Returns (shard, first_id, last_id), None if all are taken
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                lease = self.connection.execute("""SELECT shard, first_id, last_id FROM shards
+                                                   WHERE done = 0 AND (owner IS NULL OR expires < ?)
+                                                   ORDER BY shard LIMIT 1""", (now,)).fetchone()
+                if lease:
+                    self.connection.execute('UPDATE shards SET owner = ?, expires = ? WHERE shard = ?',
+                                            (owner, now + self.lease_time, lease[0]))
+                self.connection.execute('COMMIT')
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+            return lease
+
+    def renew(self, owner, shard):
+        # Returns False if the lease was lost to another worker
+        with self.lock:
+            cursor = self.connection.execute('UPDATE shards SET expires = ? WHERE shard = ? AND owner = ? AND done = 0',
+                                             (time.time() + self.lease_time, shard, owner))
+            return cursor.rowcount == 1
+
+    def finish(self, owner, shard):
+        with self.lock:
+            self.connection.execute('UPDATE shards SET done = 1 WHERE shard = ? AND owner = ?', (shard, owner))
+
+    def release(self, owner, shard):
+        # Hands an unfinished shard back right away
+        with self.lock:
+            self.connection.execute('UPDATE shards SET owner = NULL, expires = 0 WHERE shard = ? AND owner = ? AND done = 0',
+                                    (shard, owner))
+
+    def progress(self):
+        # Returns (done, total) shards
+        with self.lock:
+            done, total = self.connection.execute('SELECT SUM(done), COUNT(*) FROM shards').fetchone()
+            return done or 0, total
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class job_journal:
+    """ Write-ahead job journal
+
+    An append-only log of every page and image job. A
+    job is written down when it is queued (E), when a
+    worker picks it up (S) and when it is done (F). Writes
+    are buffered and fsynced in batches, either every
+    "batch_size" records or every "interval" seconds, so
+    whatever happens to the process the journal on disk
+    is always a consistent prefix of the events, and
+    replaying it yields every job that was not finished.
+    """
+
+    def __init__(self, journal_file, batch_size=256, interval=0.5):
+        self.journal_file = journal_file
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.file = None
+        self.stop_flushing = threading.Event()
+        self.flusher = None
+        self.before_sync = None  # Called before every fsync of the journal
+
+    @staticmethod
+    def job_line(event, kind, job):
+        if kind == 'page':
+            return '{}|page|{}\n'.format(event, job)
+        return '{}|image|{}|{}|{}\n'.format(event, *job)
+
+    @staticmethod
+    def parse_line(line):
+        # Returns (event, kind, job), a torn last line raises ValueError
+        if not line.endswith('\n'):
+            raise ValueError('Incomplete journal record')
+        event, kind, payload = line.rstrip('\n').split('|', 2)
+        if kind == 'page':
+            return event, kind, int(payload)
+        url, page, rating = payload.rsplit('|', 2)
+        return event, kind, (url, int(page), rating)
+
+    def unfinished(self):
+        """ Replays the journal
+
+        Returns a list of (kind, job) of every job that was
+        queued but never finished, in the order they were
+        queued. Jobs that were in progress when the process
+        died are included.
+        """
+        jobs = {}
+        if not os.path.isfile(self.journal_file):
+            return []
+        with open(self.journal_file, 'r') as journal:
+            for line in journal:
+                try:
+                    event, kind, job = self.parse_line(line)
+                except ValueError:
+                    break
+                if event == 'E':
+                    jobs[(kind, job)] = True
+                elif event == 'F':
+                    jobs.pop((kind, job), None)
+        return list(jobs)
+
+    def open(self, jobs=()):
+        """ Starts a new journal
+
+        The new journal holds only the given (kind, job)
+        pairs as queued jobs. It replaces the old journal
+        atomically, which also compacts it on resume.
+        """
+        temp_path = '{}.tmp'.format(self.journal_file)
+        with open(temp_path, 'w') as journal:
+            for kind, job in jobs:
+                journal.write(self.job_line('E', kind, job))
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(temp_path, self.journal_file)
+        self.file = open(self.journal_file, 'a')
+        self.stop_flushing.clear()
+        self.flusher = threading.Thread(target=self.flush_worker, name='Journal Flusher', daemon=True)
+        self.flusher.start()
+
+    def record(self, event, kind, job):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(self.job_line(event, kind, job))
+            self.pending += 1
+            if self.pending >= self.batch_size:
+                self.sync_locked()
+
+    def sync(self):
+        with self.lock:
+            if self.file is not None:
+                self.sync_locked()
+
+    def sync_locked(self):
+        if self.before_sync is not None:
+            self.before_sync()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def flush_worker(self):
+        # Bounds the amount of events a crash can lose
+        while not self.stop_flushing.wait(self.interval):
+            if self.pending:
+                self.sync()
+
+    def close(self):
+        self.stop_flushing.set()
+        with self.lock:
+            if self.file is not None:
+                self.sync_locked()
+                self.file.close()
+                self.file = None
+
+
+class sync_batcher:
+    """ Batched fsync of downloaded files
+
+    Downloaders hand finished files over instead of
+    waiting for the disk. A background thread fsyncs them
+    "batch_size" at a time, or every "interval" seconds,
+    along with their folders, each folder once per batch.
+    flush() returns once every file handed over so far
+    is on disk.
+    """
+
+    def __init__(self, batch_size=64, interval=1):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.condition = threading.Condition()
+        self.pending = []
+        self.syncing = False
+        self.flushes = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self.sync_worker, name='Sync Batcher', daemon=True)
+        self.thread.start()
+
+    def add(self, file_path):
+        with self.condition:
+            self.pending.append(file_path)
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify_all()
+
+    def ready(self):
+        # Whether the worker should sync without waiting
+        return len(self.pending) >= self.batch_size or self.stopped or \
+            bool(self.pending and self.flushes)
+
+    def sync_worker(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(self.ready, self.interval)
+                if self.stopped and not self.pending:
+                    return
+                batch = self.pending
+                self.pending = []
+                self.syncing = bool(batch)
+            if not batch:
+                continue
+            folders = set()
+            for file_path in batch:
+                fsync_path(file_path)
+                folders.add(os.path.dirname(file_path))
+            # A renamed file is only durable with its folder
+            for folder in folders:
+                fsync_path(folder or '.')
+            with self.condition:
+                self.syncing = False
+                self.condition.notify_all()
+
+    def flush(self):
+        with self.condition:
+            self.flushes += 1
+            self.condition.notify_all()
+            self.condition.wait_for(lambda: not self.pending and not self.syncing)
+            self.flushes -= 1
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+
+
+class archive_writer:
+    """ Rolling archive shards
+
+    Packs images into "tar" or "zip" shards in folder
+    instead of keeping one file per image. Once a shard
+    reaches "shard_size" bytes it is closed and the next
+    image starts a new one. Shards are created exclusively
+    and never reopened, so a resumed crawl or several
+    worker processes each write shards of their own.
+
+    Next to every shard a sidecar index ("<shard>.index")
+    has one JSON line per image with its name, size, md5
+    and the offset of its bytes in the shard, so an image
+    can be read straight off the shard. The sidecar stays
+    usable even if a crash kept a zip shard from getting
+    its central directory.
+    """
+
+    def __init__(self, folder, archive_format='tar', shard_size=1024 ** 3, syncer=False):
+        self.folder = folder
+        self.archive_format = archive_format
+        self.shard_size = shard_size
+        self.syncer = syncer
+        self.lock = threading.Lock()
+        self.shard_name = None
+        self.file = None
+        self.archive = None
+        self.sidecar = None
+        os.makedirs('{}staging'.format(folder), exist_ok=True)
+
+    def open_shard(self):
+        # Takes the first shard number no other writer has
+        number = 1
+        while True:
+            shard_name = 'images-{:06d}.{}'.format(number, self.archive_format)
+            try:
+                self.file = open('{}{}'.format(self.folder, shard_name), 'xb')
+                break
+            except FileExistsError:
+                number += 1
+        self.shard_name = shard_name
+        if self.archive_format == 'zip':
+            self.archive = zipfile.ZipFile(self.file, 'w', zipfile.ZIP_STORED, allowZip64=True)
+        else:
+            self.archive = tarfile.open(fileobj=self.file, mode='w')
+        self.sidecar = open('{}{}.index'.format(self.folder, shard_name), 'w')
+
+    def add(self, file_path, name, md5=None):
+        """ Packs a file into the current shard
+
+        Copies the file at file_path into the shard as name
+        and records it in the sidecar index. Returns the
+        shard's file name and the offset of the image in it.
+        """
+        size = os.path.getsize(file_path)
+        with self.lock:
+            if self.archive is None:
+                self.open_shard()
+            with open(file_path, 'rb') as image:
+                if self.archive_format == 'zip':
+                    info = zipfile.ZipInfo(name, time.localtime()[:6])
+                    info.file_size = size
+                    with self.archive.open(info, 'w') as entry:
+                        offset = self.file.tell()
+                        shutil.copyfileobj(image, entry, 1024 * 1024)
+                    shard_length = self.file.tell()
+                else:
+                    info = tarfile.TarInfo(name)
+                    info.size = size
+                    info.mtime = time.time()
+                    info.mode = 0o644
+                    self.archive.addfile(info, image)
+                    # The data ends padded to a full block
+                    shard_length = self.archive.offset
+                    offset = shard_length - math.ceil(size / tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            self.sidecar.write(json.dumps({'name': name, 'offset': offset, 'size': size, 'md5': md5}) + '\n')
+            self.sidecar.flush()
+            shard_name = self.shard_name
+            if self.syncer:
+                self.syncer.add('{}{}'.format(self.folder, shard_name))
+                self.syncer.add('{}{}.index'.format(self.folder, shard_name))
+            if shard_length >= self.shard_size:
+                self.close_shard()
+        return shard_name, offset
+
+    def close_shard(self):
+        # Writes the end of the tar or the zip's central
+        # directory, the next image starts a new shard
+        self.archive.close()
+        self.file.close()
+        self.sidecar.close()
+        if self.syncer:
+            self.syncer.add('{}{}'.format(self.folder, self.shard_name))
+        self.archive = None
+
+    def close(self):
+        with self.lock:
+            if self.archive is not None:
+                self.close_shard()
+
+
+class frontier_queue(queue.Queue):
+    """ Bounded work frontier
+
+    A queue.Queue whose blocking put() waits while
+    "maxsize" jobs are queued, which makes the crawlers
+    wait for the downloaders instead of collecting the
+    whole site's post list in memory. Jobs that must not
+    block (restored progress, retries, exit signals) are
+    queued with put_overflow(); once more than
+    "memory_items" jobs are queued the rest is spilled to
+    a temporary segment file and read back in order.
+    """
+
+    def __init__(self, maxsize=0, memory_items=1000, spill_dir=None):
+        self.memory_items = max(memory_items, maxsize)
+        self.spill_dir = spill_dir
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self.queue = collections.deque()
+        self.spill_file = None
+        self.spilled = 0
+        self.spill_offset = 0
+
+    def _qsize(self):
+        return len(self.queue) + self.spilled
+
+    def _put(self, item):
+        # Jobs go to disk while older jobs are still there
+        if not self.spilled and len(self.queue) < self.memory_items:
+            self.queue.append(item)
+            return
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(dir=self.spill_dir, prefix='konadl-', suffix='.spill')
+        self.spill_file.seek(0, os.SEEK_END)
+        self.spill_file.write(json.dumps(item).encode() + b'\n')
+        self.spilled += 1
+
+    def _get(self):
+        if not self.queue:
+            self.refill()
+        return self.queue.popleft()
+
+    def refill(self):
+        # Moves the oldest spilled jobs back into memory
+        self.spill_file.seek(self.spill_offset)
+        while self.spilled and len(self.queue) < self.memory_items:
+            item = json.loads(self.spill_file.readline())
+            self.queue.append(tuple(item) if isinstance(item, list) else item)
+            self.spilled -= 1
+        self.spill_offset = self.spill_file.tell()
+        if not self.spilled:
+            self.spill_file.seek(0)
+            self.spill_file.truncate()
+            self.spill_offset = 0
+
+    def put_overflow(self, item):
+        # Queues item without waiting, even if the frontier is full
+        with self.mutex:
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def requeue(self, item):
+        # Queues a job whose task is still unfinished, such
+        # as a retry, without counting it as a new task
+        with self.mutex:
+            self._put(item)
+            self.not_empty.notify()
+
+    def clear(self):
+        with self.mutex:
+            self.queue.clear()
+            self.spilled = 0
+            self.spill_offset = 0
+            if self.spill_file is not None:
+                self.spill_file.seek(0)
+                self.spill_file.truncate()
+            self.not_full.notify_all()
+
+    def close(self):
+        with self.mutex:
+            if self.spill_file is not None:
+                self.spill_file.close()
+                self.spill_file = None
+
+
+class retry_scheduler:
+    """ Delayed retries of failed jobs
+
+    Counts the failed attempts of every job and holds a
+    failed job back for an exponentially growing delay
+    with jitter before one thread puts it back into its
+    queue, so retries neither spin on the queue nor tie
+    up a worker while they wait. A job keeps counting as
+    unfinished in its queue while it is held back.
+    """
+
+    def __init__(self, max_attempts=5, backoff_base=1, backoff_max=300):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.attempts = {}
+        self.waiting = []
+        self.sequence = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.requeue_worker, name='Retry Scheduler', daemon=True)
+        self.thread.start()
+
+    def failed(self, kind, job):
+        # Counts a failed attempt, returns the attempts so far
+        with self.condition:
+            self.attempts[(kind, job)] = self.attempts.get((kind, job), 0) + 1
+            return self.attempts[(kind, job)]
+
+    def forget(self, kind, job):
+        with self.condition:
+            self.attempts.pop((kind, job), None)
+
+    def schedule(self, job_queue, kind, job):
+        # Holds job back for the backoff of its attempts so far
+        with self.condition:
+            delay = backoff_delay(self.attempts.get((kind, job), 1), self.backoff_base, self.backoff_max)
+            self.sequence += 1
+            heapq.heappush(self.waiting, (time.monotonic() + delay, self.sequence, job_queue, job))
+            self.condition.notify()
+            return delay
+
+    def requeue_worker(self):
+        while True:
+            with self.condition:
+                while not self.closed and (not self.waiting or self.waiting[0][0] > time.monotonic()):
+                    self.condition.wait(self.waiting[0][0] - time.monotonic() if self.waiting else None)
+                if self.closed:
+                    return
+                due, sequence, job_queue, job = heapq.heappop(self.waiting)
+            job_queue.requeue(job)
+
+    def pending(self):
+        with self.condition:
+            return len(self.waiting)
+
+    def clear(self):
+        # Drops the held back jobs, the journal keeps them
+        with self.condition:
+            self.waiting = []
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+class dead_letter_file:
+    """ Dead-letter file
+
+    Jobs that ran out of attempts are appended to a JSON
+    lines file together with the URL they failed at, the
+    attempts made and the last error, to be looked at or
+    crawled again later. Lines are appended in one write
+    each, so workers of a multi-process crawl can share
+    the file.
+    """
+
+    def __init__(self, dead_letter_file):
+        self.dead_letter_file = dead_letter_file
+        self.lock = threading.Lock()
+
+    def add(self, kind, job, url, attempts, reason):
+        entry = {'kind': kind, 'job': job, 'url': url, 'attempts': attempts, 'reason': reason,
+                 'time': str(datetime.datetime.now())}
+        with self.lock:
+            with open(self.dead_letter_file, 'a') as dead_letters:
+                dead_letters.write(json.dumps(entry) + '\n')
+                dead_letters.flush()
+                os.fsync(dead_letters.fileno())
+
+    def entries(self):
+        # The entries in the file, a torn last line is skipped
+        entries = []
+        if not os.path.isfile(self.dead_letter_file):
+            return entries
+        with self.lock:
+            with open(self.dead_letter_file, 'r') as dead_letters:
+                for line in dead_letters:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(entry['job'], list):
+                        entry['job'] = tuple(entry['job'])
+                    entries.append(entry)
+        return entries
+
+    def rewrite(self, entries):
+        # Atomically replaces the file with the given entries
+        with self.lock:
+            temp_file = '{}.tmp'.format(self.dead_letter_file)
+            with open(temp_file, 'w') as dead_letters:
+                for entry in entries:
+                    dead_letters.write(json.dumps(entry) + '\n')
+                dead_letters.flush()
+                os.fsync(dead_letters.fileno())
+            os.replace(temp_file, self.dead_letter_file)
+
+
+class concurrency_controller:
+    """ Adaptive worker gate
+
+    Workers take a slot for every job they picked up and
+    give it back afterwards; only "limit" of them run at
+    a time. Every interval the limit is adjusted AIMD
+    style from the responses observed meanwhile: a 429
+    or 5xx halves it, a latency more than twice the best
+    one seen or an increase that did not raise the
+    throughput takes one slot away, and one slot is
+    added while jobs are waiting for a slot. The limit
+    stays between minimum and maximum.
+    """
+
+    def __init__(self, start, minimum, maximum):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = max(self.minimum, min(start, self.maximum))
+        self.active = 0
+        self.saturated = False
+        self.requests = 0
+        self.throttled = 0
+        self.latency = 0
+        self.window_start = time.monotonic()
+        self.best_latency = None
+        self.last_throughput = 0
+        self.increased = False
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.saturated = True
+                self.condition.wait()
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def observe(self, seconds, status_code):
+        # Records a response of the workers behind this gate
+        with self.condition:
+            self.requests += 1
+            self.latency += seconds
+            if status_code == 429 or status_code >= 500:
+                self.throttled += 1
+
+    def adjust(self):
+        # Ends the current window and moves the limit
+        with self.condition:
+            now = time.monotonic()
+            elapsed = max(now - self.window_start, 0.001)
+            requests, throttled, latency = self.requests, self.throttled, self.latency
+            self.requests = self.throttled = self.latency = 0
+            self.window_start = now
+            saturated = self.saturated
+            self.saturated = False
+            if not requests:
+                return self.limit
+            average = latency / requests
+            throughput = requests / elapsed
+            if self.best_latency is None or average < self.best_latency:
+                self.best_latency = average
+            increased = self.increased
+            self.increased = False
+            if throttled:
+                self.limit = max(self.minimum, self.limit // 2)
+            elif average > self.best_latency * 2 or (increased and throughput < self.last_throughput * 1.05):
+                self.limit = max(self.minimum, self.limit - 1)
+            elif saturated and self.limit < self.maximum:
+                self.limit += 1
+                self.increased = True
+            self.last_throughput = throughput
+            self.condition.notify_all()
+            return self.limit
+
+
+class pipeline_metrics:
+    """ Crawl and download metrics
+
+    Thread safe counters and latency histograms shared by
+    every crawler and downloader thread. Gauges such as
+    queue depths are functions read when a snapshot is
+    taken. Snapshots can be written to a stats file as
+    Prometheus text or JSON.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.histograms = {}
+        self.gauges = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def inc(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def observe(self, name, seconds):
+        # Records a duration in the histogram of a stage
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = {'buckets': [0] * (len(self.BUCKETS) + 1), 'count': 0, 'sum': 0}
+            histogram = self.histograms[name]
+            histogram['buckets'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+
+    def gauge(self, name, function):
+        with self.lock:
+            self.gauges[name] = function
+
+    def quantile(self, histogram, fraction):
+        # Upper bound of the bucket holding the quantile
+        rank = histogram['count'] * fraction
+        seen = 0
+        for bound, count in zip(self.BUCKETS + (float('inf'),), histogram['buckets']):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return 0
+
+    def snapshot(self):
+        """ Current metrics
+
+        Returns the counters, the gauge values and every
+        histogram's cumulative bucket counts, count, sum and
+        p50/p99 estimates in seconds.
+        """
+        with self.lock:
+            gauges = dict(self.gauges)
+            snapshot = {'uptime': round(time.time() - self.started, 3),
+                        'counters': dict(self.counters),
+                        'histograms': {}}
+            for name, histogram in self.histograms.items():
+                buckets = {}
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ('+Inf',), histogram['buckets']):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                snapshot['histograms'][name] = {'buckets': buckets,
+                                                'count': histogram['count'],
+                                                'sum': round(histogram['sum'], 6),
+                                                'p50': self.quantile(histogram, 0.5),
+                                                'p99': self.quantile(histogram, 0.99)}
+        snapshot['gauges'] = {name: function() for name, function in gauges.items()}
+        return snapshot
+
+    def prometheus_text(self, snapshot=None):
+        # Renders a snapshot in the Prometheus text format
+        snapshot = snapshot or self.snapshot()
+        lines = ['# TYPE konadl_uptime_seconds gauge',
+                 'konadl_uptime_seconds {}'.format(snapshot['uptime'])]
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('# TYPE konadl_{}_total counter'.format(name))
+            lines.append('konadl_{}_total {}'.format(name, value))
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append('# TYPE konadl_{} gauge'.format(name))
+            lines.append('konadl_{} {}'.format(name, value))
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            lines.append('# TYPE konadl_{}_seconds histogram'.format(name))
+            for bound, count in histogram['buckets'].items():
+                lines.append('konadl_{}_seconds_bucket{{le="{}"}} {}'.format(name, bound, count))
+            lines.append('konadl_{}_seconds_sum {}'.format(name, histogram['sum']))
+            lines.append('konadl_{}_seconds_count {}'.format(name, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, stats_file, stats_format='prometheus'):
+        # Replaces the stats file with a current snapshot
+        if stats_format == 'json':
+            content = json.dumps(self.snapshot(), indent=2) + '\n'
+        else:
+            content = self.prometheus_text()
+        temp_file = '{}.tmp'.format(stats_file)
+        with open(temp_file, 'w') as stats:
+            stats.write(content)
+        os.replace(temp_file, stats_file)
+
+
+class image_stream:
+    """ Byte stream of an image
+
+    Wraps a streamed image response for iter_downloads.
+    The body can be iterated over chunk by chunk or read
+    like a file with read(). Chunks pass the bandwidth
+    limiter like those of downloads to storage. Once the
+    whole body is read its length and, if an md5 is given,
+    its md5 are checked; a faulty image raises an
+    exception on the last read.
+    """
+
+    def __init__(self, response, chunk_size, bandwidth, metrics, md5=None, on_close=None):
+        self.response = response
+        self.url = response.url
+        self.file_name = url_file_name(response.url)
+        self.length = response_image_length(response)
+        self.md5 = md5
+        self.bandwidth = bandwidth
+        self.metrics = metrics
+        self.on_close = on_close
+        self.host = urllib.parse.urlsplit(response.url).netloc
+        self.chunks = response.iter_content(chunk_size=chunk_size)
+        self.buffer = b''
+        self.bytes_read = 0
+        self.hash = hashlib.md5()
+        self.finished = False
+        self.closed = False
+
+    def next_chunk(self):
+        # The next chunk of the body, b'' once it is read
+        if self.finished:
+            return b''
+        for chunk in self.chunks:
+            if not chunk:
+                continue
+            self.bandwidth.consume(self.host, len(chunk))
+            self.bytes_read += len(chunk)
+            self.hash.update(chunk)
+            self.metrics.inc('image_bytes', len(chunk))
+            if self.length is not None and self.bytes_read > self.length:
+                raise Exception('Faulty download')
+            return chunk
+        self.finished = True
+        if self.length is not None and self.bytes_read != self.length:
+            raise Exception('Faulty download')
+        if self.md5 is not None and self.hash.hexdigest() != self.md5:
+            self.metrics.inc('corrupt_images')
+            raise Exception('Faulty download')
+        self.metrics.inc('images_streamed')
+        return b''
+
+    def __iter__(self):
+        if self.buffer:
+            chunk, self.buffer = self.buffer, b''
+            yield chunk
+        for chunk in iter(self.next_chunk, b''):
+            yield chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.buffer + b''.join(iter(self.next_chunk, b''))
+            self.buffer = b''
+            return data
+        while len(self.buffer) < size:
+            chunk = self.next_chunk()
+            if not chunk:
+                break
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.response.close()
+        if self.on_close:
+            self.on_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+class crawl_plan:
+    """ Size of a crawl
+
+    Thread safe tally of what a crawl would download,
+    filled by the planning crawlers: the number of images
+    and their bytes per rating, split into those already
+    in storage and new ones. Posts whose size the index
+    does not tell are counted as such, and so are pages
+    that could not be fetched.
+    """
+
+    def __init__(self):
+        self.ratings = {}
+        self.pages = 0
+        self.failed_pages = 0
+        self.oversized = 0
+        self.lock = threading.Lock()
+
+    def add(self, rating, size, new):
+        with self.lock:
+            if rating not in self.ratings:
+                self.ratings[rating] = {'images': 0, 'bytes': 0, 'new_images': 0, 'new_bytes': 0,
+                                        'unknown_size': 0, 'new_unknown_size': 0}
+            counts = self.ratings[rating]
+            counts['images'] += 1
+            counts['bytes'] += size or 0
+            if new:
+                counts['new_images'] += 1
+                counts['new_bytes'] += size or 0
+            if size is None:
+                counts['unknown_size'] += 1
+                counts['new_unknown_size'] += int(new)
+
+    def page_done(self):
+        with self.lock:
+            self.pages += 1
+
+    def page_failed(self):
+        with self.lock:
+            self.failed_pages += 1
+
+    def skip_oversized(self):
+        with self.lock:
+            self.oversized += 1
+
+    def report(self, elapsed, download_rate=None):
+        """ Summary of the plan
+
+        Returns the counts per rating and in total, the
+        seconds the index crawl took and the projected
+        duration of the crawl. The download part of it is
+        the new bytes at download_rate (bytes per second),
+        new images of unknown size taken at the average
+        known size. It is None if no rate or no size is
+        known.
+        """
+        with self.lock:
+            ratings = {rating: dict(counts) for rating, counts in self.ratings.items()}
+            report = {'pages': self.pages, 'failed_pages': self.failed_pages,
+                      'oversized': self.oversized, 'ratings': ratings}
+        total = {key: sum(counts[key] for counts in ratings.values())
+                 for key in ('images', 'bytes', 'new_images', 'new_bytes', 'unknown_size', 'new_unknown_size')}
+        report['total'] = total
+        report['download_rate'] = download_rate
+        report['index_seconds'] = round(elapsed, 3)
+        report['download_seconds'] = None
+        report['projected_seconds'] = None
+        known_sizes = total['images'] - total['unknown_size']
+        if download_rate and (known_sizes or not total['new_images']):
+            new_bytes = total['new_bytes']
+            if total['new_unknown_size']:
+                new_bytes += total['bytes'] / known_sizes * total['new_unknown_size']
+            report['download_seconds'] = round(new_bytes / download_rate, 3)
+            report['projected_seconds'] = round(elapsed + report['download_seconds'], 3)
+        return report
+
+
 class konadl:
     """
     Konachan Downloader
@@ -69,18 +1938,86 @@ class konadl:
         self.separate = False
         self.total_downloads = 0
         self.pages = False
+        self.first_page = 1  # First index page crawled
         self.crawl_all = False
         self.yandere = False  # Use Yande.re website
+        self.post_source = 'html'  # Index backend, "html" or "json"
+        self.use_index = True  # Skip posts recorded in the download index
+        self.index_rate = 10  # Index page requests per second, 0 is unlimited
+        self.image_rate = 30  # Image requests per second per host, 0 is unlimited
+        self.limiter = False
+        self.max_bandwidth = 0  # Image bytes per second in total, 0 is unlimited
+        self.host_bandwidth = 0  # Image bytes per second per host, 0 is unlimited
+        self.bandwidth = False
+        self.bandwidth_file = False  # File to reread the bandwidth caps from while running
+        self.bandwidth_file_mtime = None
+        self.index = False
         self.safe = True
         self.explicit = False
         self.questionable = False
         self.current_newest_id = False
         self.previous_newest_id = False
-        self.post_crawler_threads_amount = 10
-        self.downloader_threads_amount = 20
+        self.id_range = False  # (first, last) post ids to crawl, used by update
+        self.tags = ''  # Tag query, e.g. "landscape -sky"
+        self.variant = 'original'  # File to download, "original", "jpeg", "sample" or "smallest"
+        self.min_resolution = 0  # Pixels on the long side "smallest" has to reach
+        self.max_file_size = 0  # Bytes, larger images are skipped, 0 is unlimited
+        self.max_resolution = 0  # Pixels on the long side, larger images are skipped, 0 is unlimited
+        self.pinned_options = set()  # Options read_metadata does not take from the metadata file
+        self.shard_size = 10000  # Post ids per shard of a multi-process crawl
+        self.lease_time = 120  # Seconds a shard lease lasts without renewal
+        self.lease_lost = threading.Event()
+        self.shared_storage = False  # Storage is shared with workers on other hosts
+        self.progress_dir = False  # Folder of the progress files, storage if False
+        self.content_addressed = False  # Store images once under objects/ by md5
+        self.layout = 'flat'  # Folders images are spread over, "flat", "md5" or "id"
+        self.layout_id_size = 10000  # Post ids per folder of the "id" layout
+        self.preallocate = True  # Reserve the disk space of an image before writing it
+        self.fsync_batch = 64  # Downloaded images fsynced at once, 0 leaves it to the OS
+        self.syncer = False
+        self.archive_format = False  # Pack images into "tar" or "zip" shards instead of files
+        self.archive_size = 1024 ** 3  # Bytes per archive shard before the next one is started
+        self.archive = False
+        self.use_page_cache = True  # Revalidate index pages instead of fetching them again
+        self.page_cache_age = 30 * 86400  # Seconds a cached page is kept without being revalidated
+        self.page_cache_pages = 10000  # Most pages kept in the page cache
+        self.page_cache = False
+        self.page_memo_time = 60  # Seconds an index page is reused without asking the server
+        self.page_memo = {}
+        self.page_memo_lock = threading.Lock()
+        self.post_crawler_threads_amount = 10  # Crawlers running at first
+        self.downloader_threads_amount = 20  # Downloaders running at first
+        self.max_post_crawler_threads = 20
+        self.max_downloader_threads = 40
+        self.min_threads = 1
+        self.adaptive_concurrency = True  # Adjust the running workers to the server
+        self.concurrency_interval = 2  # Seconds between adjustments
+        self.crawler_concurrency = False
+        self.downloader_concurrency = False
+        self.chunk_size = 64 * 1024  # Bytes held in memory per downloader
+        self.download_queue_size = 500  # Crawlers wait while this many images are queued
+        self.frontier_memory_items = 1000  # Queued jobs kept in memory, the rest is spilled to disk
         self.job_done = False
+        self.stopping = False
         self.load_progress = False
+        self.max_attempts = 5  # Attempts of a job before it is dead-lettered
+        self.retry_base = 1  # Seconds before the second attempt, doubled for every further one
+        self.retry_max = 300
+        self.retry_scheduler = False
+        self.dead_letters = False
+        self.retry_jobs = []  # Dead-lettered jobs crawled again by retry_failed
+        self.retry_left = []  # Dead-letter entries retry_failed could not turn into jobs
+        self.download_rate = 0  # Image bytes per second measured by the last run
         self.error_logs_file = False
+        self.journal = False
+        self.sessions = False
+        self.metrics = pipeline_metrics()
+        self.metrics_format = 'prometheus'  # Stats file format, "prometheus" or "json"
+        self.metrics_interval = 10  # Seconds between stats file writes, 0 disables the file
+        self.metrics_stop = threading.Event()
+        self.downloads_lock = threading.Lock()
+        self.log_level = logging.DEBUG  # Print hooks below this level are skipped
+        self.log_writer = log_writer()
         self.headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) \
                         AppleWebKit/537.36 (KHTML, like Gecko) Chrome/65.0.3325.181 \
                         Safari/537.36'}
@@ -99,36 +2036,232 @@ class konadl:
     def write_traceback(self, url=False, page=False):
         """ Records traceback information
 
-        This method prints the error message to screen and
-        writes the full traceback information to error log
-        if self.error_logs_file is defined.
+        Hands the traceback of the exception being handled
+        to the log writer, which prints it to screen and
+        appends it to the error log if self.error_logs_file
+        is defined.
         """
+        entry = ['TIME={}\n'.format(str(datetime.datetime.now()))]
+        if page:
+            entry.append('PAGE={}\n'.format(page))
+        if url:
+            entry.append('URL={}\n'.format(url))
+        entry.append(traceback.format_exc())
+        entry.append('\n')
         # print error to screen
-        traceback.print_exc()
+        if logging.ERROR >= self.log_level:
+            self.log_writer.submit(sys.stderr.write, entry[-2])
         # writes error to log
         if self.error_logs_file:
-            self.error_log_lock.acquire()
-            with open(self.error_logs_file, 'a+') as error_file:
-                error_file.write('TIME={}\n'.format(
-                    str(datetime.datetime.now())))
-                if page:
-                    error_file.write('PAGE={}\n'.format(page))
-                if url:
-                    error_file.write('URL={}\n'.format(url))
-                traceback.print_exc(file=error_file)
-                error_file.write('\n')
-                error_file.close()
-            self.error_log_lock.release()
+            self.log_writer.submit(self.log_writer.append, self.error_logs_file, ''.join(entry))
 
-    def process_crawling_options(self):
-        """ Processes crawling options
+    def process_network_options(self):
+        """ Processes network options
 
-        Processes crawling information. Core function is to
-        determine the value for self.site_root.
+        Determines the value for self.site_root and sets up
+        what requests go through: the post source, the rate
+        and bandwidth limiters and the session pool. Nothing
+        in storage is touched.
         """
         self.site_root = 'https://konachan.com'
+        self.site_name = 'konachan.com'
         if self.yandere:
             self.site_root = 'https://yande.re'
+            self.site_name = 'yande.re'
+        if not self.limiter:
+            self.limiter = rate_limiter(self.index_rate, self.image_rate)
+        if not self.bandwidth:
+            self.bandwidth = bandwidth_limiter(self.max_bandwidth, self.host_bandwidth)
+        self.source = POST_SOURCES[self.post_source](self.site_root)
+        # Every crawler and downloader thread may hold one
+        # connection to the same host at a time
+        if not self.sessions:
+            self.sessions = session_pool(
+                self.crawler_thread_count() + self.downloader_thread_count(), self.headers)
+
+    def process_crawling_options(self):
+        """ Processes crawling options
+
+        Processes the network options and opens what a crawl
+        keeps in storage: the download index, the page cache
+        and the layout recorded there.
+        """
+        self.process_network_options()
+        if self.use_index and not self.index:
+            self.index = download_index('{}downloads.db'.format(self.storage), self.shared_storage)
+        if self.use_page_cache and not self.page_cache:
+            self.page_cache = page_cache('{}pages.db'.format(self.storage), self.shared_storage,
+                                         self.page_cache_age, self.page_cache_pages)
+        # All images of a storage follow the same layout
+        stored_layout = self.read_layout()
+        if stored_layout:
+            self.layout, self.layout_id_size = stored_layout
+
+    def fetch(self, url, budget='index', **kwargs):
+        """ Rate limited GET request
+
+        Sends the request through the pooled sessions once
+        the rate limiter allows it. Index pages share the
+        "index" budget, images are limited per image host.
+        Throttling responses (429/5xx) make the limiter back
+        off, the response is returned either way.
+        """
+        if budget == 'image':
+            budget = 'image {}'.format(urllib.parse.urlsplit(url).netloc)
+        self.limiter.acquire(budget)
+        start = time.perf_counter()
+        response = self.sessions.get(url, **kwargs)
+        elapsed = time.perf_counter() - start
+        self.metrics.observe('index_fetch' if budget == 'index' else 'image_fetch', elapsed)
+        controller = self.crawler_concurrency if budget == 'index' else self.downloader_concurrency
+        if controller:
+            controller.observe(elapsed, response.status_code)
+        if response.status_code == 429:
+            self.metrics.inc('throttled_responses')
+        elif response.status_code >= 500:
+            self.metrics.inc('server_errors')
+        if response.status_code == 429 or response.status_code >= 500:
+            self.limiter.penalize(budget, retry_after_seconds(response.headers.get('retry-after')))
+        else:
+            self.limiter.reward(budget)
+        return response
+
+    def fetch_index(self, url):
+        """ Fetches and parses an index page
+
+        Returns the response and what the post source
+        parsed off of it ("posts" and/or "total_pages"). A
+        page already parsed in the last page_memo_time
+        seconds is reused without a request (the response
+        is then None). Pages in the page cache are
+        revalidated with If-None-Match / If-Modified-Since,
+        and a 304 answer returns the result parsed back
+        then. The result is None if the server did not send
+        the page.
+        """
+        with self.page_memo_lock:
+            memo = self.page_memo.get(url)
+        if memo and time.monotonic() - memo[0] < self.page_memo_time:
+            self.metrics.inc('index_memo_hits')
+            return None, memo[1]
+
+        cached = self.page_cache.get(url) if self.page_cache else None
+        headers = {}
+        if cached and cached[0]:
+            headers['If-None-Match'] = cached[0]
+        if cached and cached[1]:
+            headers['If-Modified-Since'] = cached[1]
+        response = self.fetch(url, headers=headers)
+        if response.status_code == requests.codes.not_modified and cached:
+            self.metrics.inc('index_cache_hits')
+            self.page_cache.touch(url)
+            result = cached[2]
+        elif response.status_code == requests.codes.ok:
+            start = time.perf_counter()
+            result = self.source.parse_index(response)
+            self.metrics.observe('parse', time.perf_counter() - start)
+            etag = response.headers.get('etag')
+            last_modified = response.headers.get('last-modified')
+            if self.page_cache and (etag or last_modified):
+                self.page_cache.put(url, etag, last_modified, result)
+        else:
+            return response, None
+        with self.page_memo_lock:
+            now = time.monotonic()
+            if len(self.page_memo) >= 100:
+                for memo_url, memo in list(self.page_memo.items()):
+                    if now - memo[0] >= self.page_memo_time:
+                        del self.page_memo[memo_url]
+            self.page_memo[url] = (now, result)
+        return response, result
+
+    def crawler_thread_count(self):
+        # Crawler threads started, the most that may run at once
+        if not self.adaptive_concurrency:
+            return self.post_crawler_threads_amount
+        return max(self.post_crawler_threads_amount, self.max_post_crawler_threads)
+
+    def downloader_thread_count(self):
+        if not self.adaptive_concurrency:
+            return self.downloader_threads_amount
+        return max(self.downloader_threads_amount, self.max_downloader_threads)
+
+    def adjust_concurrency_worker(self, stop):
+        """ Resizes the worker pools while crawling
+
+        Every concurrency_interval seconds the crawler and
+        downloader gates move their limits according to the
+        responses seen since the last adjustment.
+        """
+        while not stop.wait(self.concurrency_interval):
+            self.crawler_concurrency.adjust()
+            self.downloader_concurrency.adjust()
+
+    def set_bandwidth(self, max_bandwidth, host_bandwidth):
+        """ Changes the bandwidth caps
+
+        Can be called from any thread while crawling, the
+        running downloads slow down or speed up with their
+        next chunk.
+        """
+        self.max_bandwidth = max_bandwidth
+        self.host_bandwidth = host_bandwidth
+        if self.bandwidth:
+            self.bandwidth.set_rates(max_bandwidth, host_bandwidth)
+
+    def watch_bandwidth_worker(self, stop):
+        """ Applies edits of the bandwidth file
+
+        Checks bandwidth_file every second and applies the
+        "total" and "per_host" caps of its [BANDWIDTH]
+        section whenever the file has changed.
+        """
+        while not stop.wait(1):
+            try:
+                mtime = os.path.getmtime(self.bandwidth_file)
+                if mtime == self.bandwidth_file_mtime:
+                    continue
+                self.bandwidth_file_mtime = mtime
+                caps = configparser.ConfigParser(interpolation=None)
+                caps.read(self.bandwidth_file)
+                self.set_bandwidth(byte_size(caps['BANDWIDTH'].get('total', self.max_bandwidth)),
+                                   byte_size(caps['BANDWIDTH'].get('per_host', self.host_bandwidth)))
+            except (OSError, KeyError, ValueError, configparser.Error):
+                self.write_traceback()
+
+    def metrics_file(self):
+        extension = 'json' if self.metrics_format == 'json' else 'prom'
+        return self.progress_path('metrics.{}'.format(extension))
+
+    def start_metrics_exporter(self):
+        """ Starts writing the stats file
+
+        Writes a snapshot of self.metrics to metrics.prom or
+        metrics.json in storage every metrics_interval
+        seconds until the crawl ends.
+        """
+        self.metrics_stop = threading.Event()
+        if not self.metrics_interval:
+            return
+        thread = threading.Thread(target=self.export_metrics_worker, daemon=True)
+        thread.name = 'Metrics Exporter'
+        thread.start()
+
+    def stop_metrics_exporter(self):
+        # Stops the exporter and writes the final numbers
+        self.metrics_stop.set()
+        if self.metrics_interval:
+            self.export_metrics()
+
+    def export_metrics_worker(self):
+        while not self.metrics_stop.wait(self.metrics_interval):
+            self.export_metrics()
+
+    def export_metrics(self):
+        try:
+            self.metrics.write(self.metrics_file(), self.metrics_format)
+        except OSError:
+            self.write_traceback()
 
     def crawl(self):
         """ Generic crawling
@@ -139,26 +2272,69 @@ class konadl:
         """
         self.process_crawling_options()
         self.error_logs_file = '{}errors.log'.format(self.storage)
+        self.stopping = False
 
         # Initialize page queue and downloader queue
-        self.post_queue = queue.Queue()
-        self.download_queue = queue.Queue()
+        self.post_queue = frontier_queue(self.crawler_thread_count() * 2,
+                                         self.frontier_memory_items, self.storage)
+        self.download_queue = frontier_queue(self.download_queue_size,
+                                             self.frontier_memory_items, self.storage)
+        self.metrics.gauge('post_queue_depth', self.post_queue.qsize)
+        self.metrics.gauge('download_queue_depth', self.download_queue.qsize)
+        # Every thread is started, the gates decide how many run
+        self.crawler_concurrency = concurrency_controller(
+            self.post_crawler_threads_amount, self.min_threads, self.crawler_thread_count())
+        self.downloader_concurrency = concurrency_controller(
+            self.downloader_threads_amount, self.min_threads, self.downloader_thread_count())
+        self.metrics.gauge('crawler_limit', lambda: self.crawler_concurrency.limit)
+        self.metrics.gauge('downloader_limit', lambda: self.downloader_concurrency.limit)
+        self.metrics.gauge('bandwidth_limit', lambda: self.bandwidth.total.rate)
+        self.metrics.gauge('bandwidth_throttled_seconds', lambda: self.bandwidth.stats()['total']['throttled_time'])
+        background_stop = threading.Event()
         # Prepare containers for threads
         self.page_threads = []
         self.downloader_threads = []
 
-        self.print_lock = threading.Lock()
-        self.error_log_lock = threading.Lock()
-
         # load progress from progress file if needed
+        self.journal = job_journal(self.progress_path('jobs.journal'))
+        if self.fsync_batch:
+            self.syncer = sync_batcher(self.fsync_batch)
+            # The journal never says an image is done
+            # before the image is on disk
+            self.journal.before_sync = self.syncer.flush
+        if self.archive_format:
+            self.archive = archive_writer('{}archives/'.format(self.storage), self.archive_format,
+                                          self.archive_size, self.syncer)
+        self.retry_scheduler = retry_scheduler(self.max_attempts, self.retry_base, self.retry_max)
+        self.dead_letters = dead_letter_file('{}dead_letters.jsonl'.format(self.storage))
+        self.metrics.gauge('retries_waiting', self.retry_scheduler.pending)
+        restored_jobs = []
         if self.load_progress:
-            self.read_queues()
+            restored_jobs = self.read_queues()
+        # The restored jobs are the new journal's starting point
+        self.journal.open(restored_jobs)
+        del restored_jobs
+        if self.retry_jobs:
+            for job in self.retry_jobs:
+                self.journal.record('E', 'image', job)
+                self.download_queue.put_overflow(job)
+            # The journal has them now, failing again
+            # puts them back into the dead-letter file
+            self.journal.sync()
+            self.dead_letters.rewrite(self.retry_left)
+            self.retry_jobs = []
+            self.retry_left = []
 
         try:
-            self.current_newest_id = self.get_newest_image_id()
+            if not self.current_newest_id:
+                self.current_newest_id = self.get_newest_image_id()
+            # Resuming after a crash needs the crawl settings
+            self.save_metadata()
+            self.save_layout()
+            self.start_metrics_exporter()
 
             # Create post crawler threads
-            for identifier in range(self.post_crawler_threads_amount):
+            for identifier in range(self.crawler_thread_count()):
                 thread = threading.Thread(target=self.crawl_post_page_worker, args=(
                     self.post_queue, self.download_queue))
                 thread.name = 'Post Crawler {}'.format(identifier)
@@ -166,68 +2342,254 @@ class konadl:
                 self.page_threads.append(thread)
 
             # Create image downloader threads
-            for identifier in range(self.downloader_threads_amount):
+            for identifier in range(self.downloader_thread_count()):
                 thread = threading.Thread(
                     target=self.retrieve_post_image_worker, args=(self.download_queue,))
                 thread.name = 'Downloader {}'.format(identifier)
                 thread.start()
                 self.downloader_threads.append(thread)
 
+            if self.adaptive_concurrency:
+                thread = threading.Thread(target=self.adjust_concurrency_worker, args=(background_stop,), daemon=True)
+                thread.name = 'Concurrency Controller'
+                thread.start()
+
+            if self.bandwidth_file:
+                thread = threading.Thread(target=self.watch_bandwidth_worker, args=(background_stop,), daemon=True)
+                thread.name = 'Bandwidth Watcher'
+                thread.start()
+
             # Every page is a job in the queue
             if not self.load_progress:
-                for page_num in range(1, self.pages + 1):
+                for page_num in range(self.first_page, self.pages + 1):
+                    self.journal.record('E', 'page', page_num)
                     self.post_queue.put(page_num)
 
             # Wait for all jobs to be done
-            self.post_queue.join()
-            self.download_queue.join()
+            self.wait_for_jobs(self.post_queue)
+            self.wait_for_jobs(self.download_queue)
             # Send exit signal to all threads
-            for _ in range(self.post_crawler_threads_amount):
-                self.post_queue.put(None)
-            for _ in range(self.downloader_threads_amount):
-                self.download_queue.put((None, None, None))
+            for _ in range(len(self.page_threads)):
+                self.post_queue.put_overflow(None)
+            for _ in range(len(self.downloader_threads)):
+                self.download_queue.put_overflow((None, None, None))
 
             for thread in self.page_threads:
                 thread.join()
             for thread in self.downloader_threads:
                 thread.join()
 
+            self.post_queue.close()
+            self.download_queue.close()
+            background_stop.set()
+            self.retry_scheduler.close()
+            self.stop_metrics_exporter()
             self.job_done = True
+            if self.archive:
+                self.archive.close()
+            if self.syncer:
+                self.syncer.close()
+            self.journal.close()
+            self.remove_progress_files()
             self.save_metadata()
+            self.log_writer.flush()
             return True  # Job entirely done
         except (KeyboardInterrupt, SystemExit):
             # Main thread catches KeyboardInterrupt
             # Clear queues and put None as exit signal
-            self.warn_keyboard_interrupt()
-            if not self.download_queue.empty():
-                self.save_queues()
-
-            self.post_queue.queue.clear()
-            for _ in range(self.post_crawler_threads_amount):
-                self.post_queue.put(None)
-            self.download_queue.queue.clear()
-            for _ in range(self.downloader_threads_amount):
-                self.download_queue.put((None, None, None))
+            if not self.lease_lost.is_set():
+                self.warn_keyboard_interrupt()
+            self.stopping = True
+            self.save_queues()
+
+            self.retry_scheduler.clear()
+            self.post_queue.clear()
+            for _ in range(len(self.page_threads)):
+                self.post_queue.put_overflow(None)
+            self.download_queue.clear()
+            for _ in range(len(self.downloader_threads)):
+                self.download_queue.put_overflow((None, None, None))
 
             for thread in self.page_threads:
                 thread.join()
             for thread in self.downloader_threads:
                 thread.join()
-
+            self.post_queue.close()
+            self.download_queue.close()
+            background_stop.set()
+            self.retry_scheduler.close()
+            self.stop_metrics_exporter()
+
+            if self.archive:
+                self.archive.close()
+            if self.syncer:
+                self.syncer.close()
+            self.journal.close()
             self.save_metadata()
+            self.log_writer.flush()
             return False  # Job paused
 
+    def wait_for_jobs(self, job_queue):
+        # job_queue.join() that gives up once the lease of
+        # the shard being crawled went to another worker
+        with job_queue.all_tasks_done:
+            while job_queue.unfinished_tasks:
+                if self.lease_lost.is_set():
+                    raise SystemExit('Shard lease lost')
+                job_queue.all_tasks_done.wait(1)
+
+    def plan(self):
+        """ Sizes a crawl without downloading
+
+        Walks the index pages the crawl would (self.pages
+        from first_page, or every page with crawl_all) with
+        the crawler threads and tallies the images it would
+        download, without downloading any. The JSON source
+        lists 1000 posts with their file sizes per request.
+        Images in the download index or in storage are not
+        new. The duration is projected from the download
+        rate of the last run, capped by max_bandwidth.
+        Failing pages are retried like those of a crawl and
+        counted as failed after max_attempts. Returns the
+        crawl_plan report.
+
+        The index pages end up in the page cache, so the
+        crawl after a plan only revalidates them.
+        """
+        self.process_crawling_options()
+        self.error_logs_file = '{}errors.log'.format(self.storage)
+        if self.crawl_all:
+            self.pages = self.get_total_pages()
+        plan = crawl_plan()
+        post_queue = frontier_queue()
+        retries = retry_scheduler(self.max_attempts, self.retry_base, self.retry_max)
+        start = time.perf_counter()
+        threads = []
+        for identifier in range(self.post_crawler_threads_amount):
+            thread = threading.Thread(target=self.plan_page_worker, args=(post_queue, plan, retries), daemon=True)
+            thread.name = 'Planner {}'.format(identifier)
+            thread.start()
+            threads.append(thread)
+        for page_num in range(self.first_page, self.pages + 1):
+            post_queue.put(page_num)
+        post_queue.join()
+        for _ in threads:
+            post_queue.put(None)
+        for thread in threads:
+            thread.join()
+        retries.close()
+        # The printing hooks queued so far come before the report
+        self.log_writer.flush()
+        return plan.report(time.perf_counter() - start, self.measured_download_rate())
+
+    def plan_page_worker(self, post_queue, plan, retries):
+        # Tallies the posts of index pages instead of queueing them
+        while True:
+            page = post_queue.get()
+            if page is None:
+                post_queue.task_done()
+                break
+            try:
+                self.print_crawling_page(page)
+                page_source, index_page = self.fetch_index(self.source.page_url(page, self.search_tags()))
+                if index_page is None:
+                    if page_source.status_code == 429:
+                        # The rate limiter waits before the next try
+                        self.print_429()
+                        post_queue.task_done()
+                        post_queue.put_overflow(page)
+                        continue
+                    page_source.raise_for_status()
+                    raise Exception('Unexpected response {}'.format(page_source.status_code))
+                for post in index_page['posts']:
+                    self.plan_post(post, plan)
+                plan.page_done()
+                post_queue.task_done()
+            except Exception:
+                self.write_traceback(page=page)
+                self.print_exception()
+                if retries.failed('page', page) < self.max_attempts:
+                    retries.schedule(post_queue, 'page', page)
+                else:
+                    retries.forget('page', page)
+                    plan.page_failed()
+                    post_queue.task_done()
+
+    def plan_post(self, post, plan):
+        # Same choices as enqueue_post, counted instead of queued
+        rating = self.wanted_rating(post['rating'])
+        if not rating:
+            return
+        variant = self.select_variant(post)
+        if variant is None:
+            plan.skip_oversized()
+            return
+        file_name = url_file_name(variant['url'])
+        stored = (self.index and self.index.has_post(self.site_name, post['id'])) or \
+            os.path.isfile('{}{}{}'.format(self.storage, self.image_folder(rating, file_name), file_name))
+        plan.add(rating, variant['size'], not stored)
+
+    def measured_download_rate(self):
+        # Bytes per second to project downloads with, None if unknown
+        progress = configparser.ConfigParser()
+        progress.read(self.progress_path('metadata.progress'))
+        rate = progress.getfloat('STATISTICS', 'download_rate', fallback=0)
+        if self.max_bandwidth:
+            rate = min(rate, self.max_bandwidth) if rate else self.max_bandwidth
+        return rate or None
+
+    def retry_failed(self):
+        """ Crawls the dead-lettered jobs again
+
+        Images in the dead-letter file are downloaded again
+        with fresh attempts. Page numbers only mean something
+        for the query of the crawl they failed in, so index
+        pages are fetched again by the URL they failed at and
+        their posts are downloaded; pages that still fail
+        stay in the file. Jobs failing again go back into the
+        file. Returns False if there is nothing to retry.
+        """
+        self.process_crawling_options()
+        if self.metadata_present():
+            self.read_metadata()
+            # Retrying old jobs does not make them new
+            self.current_newest_id = self.previous_newest_id
+        self.id_range = False
+        self.pages = False
+        self.dead_letters = dead_letter_file('{}dead_letters.jsonl'.format(self.storage))
+        self.retry_jobs = []
+        self.retry_left = []
+        for entry in self.dead_letters.entries():
+            if entry['kind'] == 'image':
+                self.retry_jobs.append(entry['job'])
+                continue
+            try:
+                page_source, index_page = self.fetch_index(entry['url'])
+            except Exception:
+                self.write_traceback(page=entry['job'])
+                index_page = None
+            if index_page is None:
+                self.retry_left.append(entry)
+                continue
+            for post in index_page['posts']:
+                job = self.post_job(post, entry['job'])
+                if job:
+                    self.retry_jobs.append(job)
+        if not self.retry_jobs:
+            self.dead_letters.rewrite(self.retry_left)
+            return False
+        return self.crawl()
+
     def crawl_page(self, page_num):
-        """ [OUTDATED] Crawl a specific page
+        """ Crawl a specific page
 
         This is very similar to the "crawl" method.
         Instead of crawling a number of pages, this
         method crawls images on a specific page.
         """
-        self.process_crawling_options()
-        page_posts = self.crawl_post_page(page_num)
-        for post in page_posts:
-            self.retrieve_post_image(post)
+        self.first_page = page_num
+        self.pages = page_num
+        return self.crawl()
 
     def crawl_all_pages(self):
         """ Crawl the entire site
@@ -241,63 +2603,438 @@ class konadl:
         return self.crawl()
 
     def update(self):
+        """ Download images added since the last run
+
+        Instead of walking the index from the first page
+        until the newest post of the last run shows up, only
+        the posts between that post and the current newest
+        post are searched for (an "id:N..M" query). Those
+        pages are crawled in parallel like any other crawl,
+        so the time taken depends on the amount of new
+        posts and not on the size of the site.
+        """
         self.process_crawling_options()
         self.read_metadata()
+        self.id_range = False
         self.current_newest_id = self.get_newest_image_id()
-        self.error_logs_file = '{}errors.log'.format(self.storage)
+        if not self.current_newest_id or self.current_newest_id == self.previous_newest_id:
+            return False
 
-        # Initialize page queue and downloader queue
-        self.post_queue = queue.Queue()
-        self.download_queue = queue.Queue()
-        # Prepare containers for threads
-        self.downloader_threads = []
+        # Pinning the upper end keeps page contents stable
+        # while new posts are uploaded during the update
+        self.id_range = (self.previous_newest_id + 1 if self.previous_newest_id else 1, self.current_newest_id)
+        self.pages = self.get_total_pages()
+        return self.crawl()
 
-        self.print_lock = threading.Lock()
-        self.error_log_lock = threading.Lock()
+    def crawl_shards(self, coordinator_file):
+        """ Crawl the entire site as one of many workers
+
+        Worker processes, on this host or on others sharing
+        the storage, split the site into shards of
+        shard_size post ids through a lease_coordinator in
+        coordinator_file. Every shard claimed is crawled
+        with an "id:N..M" query like update does, while a
+        background thread renews its lease.
+
+        The images and the download index are shared, so
+        posts another worker downloaded are skipped. The
+        progress files of each worker go into its own
+        folder under "shards/". A worker whose lease ran out
+        and went to another worker stops crawling that shard
+        and claims the next one. Returns False if the crawl
+        was interrupted, True once no shard is left.
+        """
+        self.crawl_all = True
+        self.load_progress = False
+        self.id_range = False
+        self.shared_storage = True
+        self.process_crawling_options()
+        coordinator = lease_coordinator(coordinator_file, self.lease_time)
+        coordinator.plan(self.get_newest_image_id(), self.shard_size)
+        owner = '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.progress_dir = '{}shards/{}/'.format(self.storage, owner)
+        os.makedirs(self.progress_dir, exist_ok=True)
 
-        if self.get_newest_image_id() == self.previous_newest_id:
-            return False
+        while True:
+            lease = coordinator.claim(owner)
+            if lease is None:
+                break
+            shard, first_id, last_id = lease
+            self.lease_lost.clear()
+            stop_renewing = threading.Event()
+            renewer = threading.Thread(target=self.renew_lease_worker,
+                                       args=(coordinator, owner, shard, stop_renewing), daemon=True)
+            renewer.name = 'Lease Renewer'
+            renewer.start()
+
+            self.id_range = (first_id, last_id)
+            self.current_newest_id = False
+            self.job_done = False
+            self.pages = self.get_total_pages()
+            finished = self.crawl() if self.pages else True
+            stop_renewing.set()
+            renewer.join()
+            if self.lease_lost.is_set():
+                # The shard's new owner crawls it, this worker
+                # goes on with another one
+                continue
+            if not finished:
+                coordinator.release(owner, shard)
+                coordinator.close()
+                return False
+            coordinator.finish(owner, shard)
 
+        coordinator.close()
+        self.remove_metatada()
         try:
+            os.rmdir(self.progress_dir)
+        except OSError:
+            pass
+        return True
 
-            # Create image downloader threads
-            for identifier in range(self.downloader_threads_amount):
-                thread = threading.Thread(
-                    target=self.retrieve_post_image_worker, args=(self.download_queue,))
-                thread.name = 'Downloader {}'.format(identifier)
-                thread.start()
-                self.downloader_threads.append(thread)
+    def renew_lease_worker(self, coordinator, owner, shard, stop_renewing):
+        # Renews the lease three times per lease time
+        while not stop_renewing.wait(self.lease_time / 3):
+            if not coordinator.renew(owner, shard):
+                self.metrics.inc('leases_lost')
+                # Stops crawling the shard, its downloads
+                # would collide with those of the new owner
+                self.lease_lost.set()
+                break
+
+    def search_tags(self, tags=None, ratings=None, id_range=None):
+        """ Tags sent along with every index request
+
+        The tag query, the wanted ratings and the id range
+        of an update. Ratings are left to the server, so
+        pages of unwanted posts are never requested: one
+        rating is "rating:x", two are "-rating:x" of the
+        third one.
+
+        Arguments left None are taken from self.tags, the
+        rating attributes and self.id_range. ratings are
+        rating names such as ["safe", "explicit"].
+        """
+        tags = (self.tags if tags is None else tags).split()
+        if ratings is None:
+            ratings = [rating for rating in RATINGS if self.wanted_rating(RATINGS[rating])]
+        else:
+            ratings = [rating for rating in RATINGS if RATINGS[rating] in ratings]
+        if len(ratings) == 1:
+            tags.append('rating:{}'.format(ratings[0]))
+        elif len(ratings) == 2:
+            tags.extend('-rating:{}'.format(rating) for rating in RATINGS if rating not in ratings)
+        id_range = self.id_range if id_range is None else id_range
+        if id_range:
+            tags.append('id:{}..{}'.format(*id_range))
+        return ' '.join(tags)
 
-            self.crawl_new_images()
+    def get_total_pages(self):
+        # Crawl the first post page and read the number of total pages
+        page_source, page = self.fetch_index(self.source.total_pages_url(self.search_tags()))
+        if page is None:
+            page_source.raise_for_status()
+        return page['total_pages']
 
-            self.download_queue.join()
-            for _ in range(self.downloader_threads_amount):
-                self.download_queue.put((None, None, None))
-            for thread in self.downloader_threads:
-                thread.join()
-            self.job_done = True
-            self.save_metadata()
-            return True
-        except (KeyboardInterrupt, SystemExit):
-            self.warn_keyboard_interrupt()
-            if not self.download_queue.empty():
-                self.save_queues()
+    def wanted_rating(self, rating):
+        """ Checks a rating against the desired ratings
 
-            self.download_queue.queue.clear()
-            for _ in range(self.downloader_threads_amount):
-                self.download_queue.put((None, None, None))
-            for thread in self.downloader_threads:
-                thread.join()
+        Returns the rating if images of this rating are to
+        be downloaded, False otherwise.
+        """
+        if rating == 'safe' and self.safe:
+            return 'safe'
+        elif rating == 'questionable' and self.questionable:
+            return 'questionable'
+        elif rating == 'explicit' and self.explicit:
+            return 'explicit'
+        return False
+
+    def enqueue_post(self, post, page):
+        """ Hands a post over to the downloaders
+
+        Puts the post into download_queue if its rating is
+        wanted and it is not in the download index yet.
+        Returns True if the post was queued.
+        """
+        job = self.post_job(post, page)
+        if not job:
+            return False
+        self.journal.record('E', 'image', job)
+        self.metrics.inc('posts_queued')
+        # Wait for the downloaders to make room, unless they
+        # are exiting, in which case the journal keeps the job
+        start = time.perf_counter()
+        while not self.stopping:
+            try:
+                self.download_queue.put(job, timeout=1)
+                self.metrics.observe('enqueue_wait', time.perf_counter() - start)
+                return True
+            except queue.Full:
+                pass
+        self.download_queue.put_overflow(job)
+        return True
 
-            self.save_metadata()
-            return False  # Job paused
+    def post_job(self, post, page):
+        # The image job of a post, False if it is not wanted,
+        # already downloaded or over the size limits
+        rating = self.wanted_rating(post['rating'])
+        if not rating:
+            return False
+        if self.index and self.index.has_post(self.site_name, post['id']):
+            return False
+        variant = self.select_variant(post)
+        if variant is None:
+            self.metrics.inc('posts_oversized')
+            return False
+        return (variant['url'], page, rating)
+
+    def select_variant(self, post):
+        """ Picks the file of a post to download
+
+        Returns the variant chosen by self.variant
+        among those within max_file_size and max_resolution,
+        or None if the post is over the limits. "smallest"
+        takes the smallest file reaching min_resolution on
+        its long side, or the largest one if none does. If
+        the file asked for is not listed the original is
+        taken.
+        Limits can only be checked where the index page
+        tells sizes and resolutions; the rest is checked
+        against content-length when the download starts.
+        """
+        variants = post.get('variants') or [{'name': 'original', 'url': post['url'],
+                                             'size': None, 'width': None, 'height': None}]
+        allowed = [variant for variant in variants if self.variant_allowed(variant)]
+        if not allowed:
+            return None
+        if self.variant == 'smallest':
+            large_enough = [variant for variant in allowed if variant_long_side(variant) >= self.min_resolution]
+            if not large_enough:
+                return max(allowed, key=variant_long_side)
+            return min(large_enough, key=lambda variant: (variant['size'] or math.inf, variant_long_side(variant)))
+        for variant in allowed:
+            if variant['name'] == self.variant:
+                return variant
+        # Pages that do not list the file asked for, e.g. HTML
+        # without Post.register data, get the original instead
+        if not any(variant['name'] == self.variant for variant in variants):
+            for variant in allowed:
+                if variant['name'] == 'original':
+                    return variant
+        # Fall back to the largest file that is still smaller
+        # than the one asked for, sample being the smallest
+        for variant in allowed:
+            if VARIANTS.index(variant['name']) > VARIANTS.index(self.variant):
+                return variant
+        return None
+
+    def variant_allowed(self, variant):
+        # Unknown sizes and resolutions pass, see select_variant
+        if self.max_file_size and (variant['size'] or 0) > self.max_file_size:
+            return False
+        if self.max_resolution and variant_long_side(variant) > self.max_resolution:
+            return False
+        return True
 
-    def get_total_pages(self):
-        # Crawl the first post page and read the number of total pages
-        index_page = requests.get('{}/post?page=1&tags='.format(self.site_root), headers=self.headers).text
-        index_soup = BeautifulSoup(index_page, "html.parser")
-        # Find the page number of the last page
-        return int(index_soup.findAll('a', href=True)[-10].text)
+    def iter_posts(self, tags=None, ratings=None, id_range=None, prefetch=2, use_page_cache=False):
+        """ Lazily lists posts
+
+        Yields the post records of the tag query and ratings
+        (see search_tags for the defaults), newest first,
+        without touching storage. Instead of page numbers
+        every request asks for the posts below the last id
+        seen ("id:N..M"), so uploads during the walk neither
+        shift nor repeat posts and only one page of posts is
+        held at a time. A background thread fetches up to
+        prefetch pages ahead of the caller; it stops when the
+        caller leaves the loop. A page failing max_attempts
+        times raises its error to the caller. With
+        use_page_cache the pages are revalidated through
+        pages.db in storage like a crawl does.
+        """
+        self.process_network_options()
+        if use_page_cache and not self.page_cache:
+            self.page_cache = page_cache('{}pages.db'.format(self.storage), self.shared_storage,
+                                         self.page_cache_age, self.page_cache_pages)
+        pages = queue.Queue(prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.prefetch_pages_worker,
+                                  args=(pages, stop, tags, ratings, id_range), daemon=True)
+        thread.name = 'Page Prefetcher'
+        thread.start()
+        try:
+            while True:
+                posts = pages.get()
+                if posts is None:
+                    return
+                if isinstance(posts, Exception):
+                    raise posts
+                yield from posts
+        finally:
+            stop.set()
+
+    def prefetch_pages_worker(self, pages, stop, tags, ratings, id_range):
+        # Walks the index for iter_posts, one id range after another
+        first_id, last_id = id_range or (1, None)
+        attempts = 0
+        try:
+            while not stop.is_set():
+                query = self.search_tags(tags, ratings, (first_id, last_id) if last_id else False)
+                url = self.source.page_url(1, query)
+                try:
+                    page_source, page = self.fetch_index(url)
+                except requests.exceptions.RequestException:
+                    self.write_traceback(url=url)
+                    self.limiter.penalize('index')
+                    attempts += 1
+                    if attempts >= self.max_attempts:
+                        raise
+                    self.metrics.inc('retries')
+                    stop.wait(backoff_delay(attempts, self.retry_base, self.retry_max))
+                    continue
+                if page is None:
+                    attempts += 1
+                    if (page_source.status_code == 429 or page_source.status_code >= 500) and attempts < self.max_attempts:
+                        self.metrics.inc('retries')
+                        stop.wait(backoff_delay(attempts, self.retry_base, self.retry_max))
+                        continue
+                    page_source.raise_for_status()
+                    raise Exception('Unexpected response {}'.format(page_source.status_code))
+                attempts = 0
+                if not page['posts']:
+                    break
+                posts = [post for post in page['posts']
+                         if (post['rating'] in ratings if ratings is not None else self.wanted_rating(post['rating']))]
+                if not put_unless_stopped(pages, posts, stop):
+                    return
+                last_id = min(post['id'] for post in page['posts']) - 1
+                if last_id < first_id:
+                    break
+            put_unless_stopped(pages, None, stop)
+        except Exception as error:
+            put_unless_stopped(pages, error, stop)
+
+    def iter_downloads(self, posts=None, prefetch=4):
+        """ Lazily downloads posts
+
+        Yields (post, stream) for every post of an iterable
+        of post records, iter_posts() by default. stream is
+        an image_stream of the file select_variant picks and
+        nothing is written to storage. prefetch threads open
+        the next images while the caller reads the current
+        one; at most prefetch images are open at a time and
+        each holds one chunk in memory. A stream is closed
+        when the caller asks for the next one.
+        """
+        self.process_network_options()
+        own_posts = self.iter_posts() if posts is None else None
+        posts = iter(posts if own_posts is None else own_posts)
+        posts_lock = threading.Lock()
+        slots = threading.Semaphore(prefetch)
+        streams = queue.Queue()
+        stop = threading.Event()
+        for identifier in range(prefetch):
+            thread = threading.Thread(target=self.prefetch_images_worker,
+                                      args=(posts, posts_lock, slots, streams, stop), daemon=True)
+            thread.name = 'Image Prefetcher {}'.format(identifier)
+            thread.start()
+        running = prefetch
+        try:
+            while running:
+                item = streams.get()
+                if item is None:
+                    running -= 1
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+                post, stream = item
+                with stream:
+                    yield post, stream
+        finally:
+            stop.set()
+            # Streams opened for nobody give their slots back
+            while True:
+                try:
+                    item = streams.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(item, tuple):
+                    item[1].close()
+            # Stops the page prefetcher of iter_posts right away
+            # instead of whenever the generator is collected
+            if own_posts is not None:
+                with posts_lock:
+                    own_posts.close()
+
+    def prefetch_images_worker(self, posts, posts_lock, slots, streams, stop):
+        # Opens images for iter_downloads while slots are free
+        try:
+            while not stop.is_set():
+                if not slots.acquire(timeout=1):
+                    continue
+                with posts_lock:
+                    post = next(posts, None)
+                if post is None:
+                    slots.release()
+                    break
+                stream = self.open_stream(post, slots.release, stop)
+                if stream is None:
+                    slots.release()
+                elif not put_unless_stopped(streams, (post, stream), stop):
+                    stream.close()
+            streams.put(None)
+        except Exception as error:
+            stop.set()
+            streams.put(error)
+
+    def open_stream(self, post, on_close, stop):
+        """ Starts streaming the image of a post
+
+        Returns an image_stream, or None if the post is over
+        the size limits or the server does not have it.
+        429/5xx responses and connection errors are retried
+        with backoff; the error of the last of max_attempts
+        attempts is raised.
+        """
+        variant = self.select_variant(post)
+        if variant is None:
+            self.metrics.inc('posts_oversized')
+            return None
+        url = variant['url']
+        attempts = 0
+        while not stop.is_set():
+            attempts += 1
+            try:
+                response = self.fetch(url, budget='image', stream=True)
+            except requests.exceptions.RequestException:
+                self.write_traceback(url=url)
+                self.limiter.penalize('image {}'.format(urllib.parse.urlsplit(url).netloc))
+                if attempts >= self.max_attempts:
+                    raise
+                self.metrics.inc('retries')
+                stop.wait(backoff_delay(attempts, self.retry_base, self.retry_max))
+                continue
+            if response.status_code == requests.codes.ok:
+                if self.max_file_size and (response_image_length(response) or 0) > self.max_file_size:
+                    response.close()
+                    self.metrics.inc('posts_oversized')
+                    return None
+                md5 = image_url_md5(url) if image_url_variant(url) == 'image' else None
+                return image_stream(response, self.chunk_size, self.bandwidth, self.metrics, md5, on_close)
+            response.close()
+            if response.status_code == 429 or response.status_code >= 500:
+                if attempts >= self.max_attempts:
+                    response.raise_for_status()
+                self.metrics.inc('retries')
+                stop.wait(backoff_delay(attempts, self.retry_base, self.retry_max))
+                continue
+            try:
+                response.raise_for_status()
+            except requests.exceptions.HTTPError:
+                self.write_traceback(url=url)
+            return None
+        return None
 
     def get_newest_image_id(self):
         """Gets the id of the newest image
@@ -306,61 +3043,10 @@ class konadl:
         of the image has to be included in the desired
         ratings.
         """
-        index_page = requests.get('{}/post?page=1&tags='.format(self.site_root), headers=self.headers).text
-        index_soup = BeautifulSoup(index_page, "html.parser")
-        posts_list = index_soup.find('ul', {'id': 'post-list-posts'})
-        posts = posts_list.findAll('li')
-        for post in posts:
-            alt = post.find('img', alt=True)['alt']
-            rating = False
-            if 'Rating: Safe'in alt and self.safe:
-                rating = 'safe'
-            elif 'Rating: Questionable' in alt and self.questionable:
-                rating = 'questionable'
-            elif 'Rating: Explicit' in alt and self.explicit:
-                rating = 'explicit'
-            if rating:
-                return(post['id'])
-
-    def crawl_new_images(self):
-        """ Load all new images
-
-        Crawl the site and append all the new images
-        since the last download into download_queue
-        """
-        update_post_queue = queue.Queue()
-        for page_num in range(1, self.get_total_pages() + 1):
-            update_post_queue.put(page_num)
-
-        while not update_post_queue.empty():
-            page = update_post_queue.get()
-            self.print_crawling_page(page)
-            page_source = requests.get('{}/post?page={}&tags='.format(self.site_root, page), headers=self.headers)
-            if page_source.status_code != requests.codes.ok:
-                if page_source.status_code == 429:
-                    self.print_429()
-                page_source.raise_for_status()
-            soup = BeautifulSoup(page_source.text, "html.parser")
-            # Find large image link and ratings
-            posts_list = soup.find('ul', {'id': 'post-list-posts'})
-            posts = posts_list.findAll('li')
-
-            for post in posts:
-                if post['id'] == self.previous_newest_id:
-                    return
-                alt = post.find('img', alt=True)['alt']
-                rating = False
-                if 'Rating: Safe'in alt and self.safe:
-                    rating = 'safe'
-                elif 'Rating: Questionable' in alt and self.questionable:
-                    rating = 'questionable'
-                elif 'Rating: Explicit' in alt and self.explicit:
-                    rating = 'explicit'
-                if rating:
-                    url = post.find('a', {'class': 'directlink'})['href']
-                    if 'https:' not in url:
-                        url = '{}{}'.format('https:', url)
-                    self.download_queue.put((url, page, rating))
+        page_source, page = self.fetch_index(self.source.page_url(1, self.search_tags()))
+        for post in page['posts'] if page else []:
+            if self.wanted_rating(post['rating']):
+                return post['id']
 
     def retrieve_post_image_worker(self, download_queue):
         """ Get the large image url and download
@@ -369,43 +3055,394 @@ class konadl:
         and calls the downloader to download all of them.
         """
         while True:
+            running = False
             try:
                 url, page, rating = download_queue.get()
                 if url is None:
                     self.print_thread_exit(
                         str(threading.current_thread().name))
                     break
+                self.downloader_concurrency.acquire()
+                running = True
+                self.journal.record('S', 'image', (url, page, rating))
+                file_name = url_file_name(url)
+                # Another worker process may have downloaded
+                # the post since it was queued
+                if self.index and self.index.has_post(file_name_site(file_name), file_name_post_id(file_name)):
+                    self.journal.record('F', 'image', (url, page, rating))
+                    download_queue.task_done()
+                    continue
                 self.print_retrieval(url, page)
-                file_name = url.split("/")[-1].replace('%20', '_').replace('_-_', '_')
-                subfolder = ''
-                if self.separate:
-                    subfolder = '{}/'.format(rating)
+                # Only original files are named after their own md5
+                md5 = image_url_md5(url) if image_url_variant(url) == 'image' else None
+                subfolder = self.image_folder(rating, file_name)
                 file_path = '{}{}{}'.format(self.storage, subfolder, file_name)
-                image_request = requests.get(url, headers=self.headers)
-                with open(file_path, 'wb') as file:
-                    file_length = file.write(image_request.content)
-                    file.close()
-                if int(image_request.headers['content-length']) != file_length:
-                    raise Exception('Faulty download')
-                elif image_request.status_code != requests.codes.ok:
+                download_path = file_path
+                if self.archive:
+                    # Images wait in staging/ until they are packed
+                    subfolder = '{}/'.format(rating) if self.separate else ''
+                    download_path = '{}staging/{}'.format(self.archive.folder, file_name)
+                else:
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                if self.content_addressed and not self.archive and image_url_md5(url):
+                    download_path = self.object_path(url, file_name)
+                    if os.path.isfile(download_path):
+                        # Same image as a post downloaded before,
+                        # on this site or the other one
+                        self.link_view(download_path, file_path)
+                        if self.index:
+                            self.index.add(file_name_site(file_name), file_name_post_id(file_name), md5,
+                                           '{}{}'.format(subfolder, file_name), os.path.getsize(download_path), rating)
+                        self.metrics.inc('images_deduplicated')
+                        self.journal.record('F', 'image', (url, page, rating))
+                        download_queue.task_done()
+                        continue
+                    os.makedirs(os.path.dirname(download_path), exist_ok=True)
+                image_request = self.fetch(url, budget='image', stream=True, headers=self.resume_headers(download_path))
+                if image_request.status_code not in (requests.codes.ok, requests.codes.partial_content):
+                    image_request.close()
                     if image_request.status_code == 429:
+                        # The rate limiter waits before the next
+                        # try, which costs the job no attempt
                         self.print_429()
-                    download_queue.task_done()
-                    download_queue.put((url, page, rating))
-                    if os.path.isfile(file_path):
-                        os.remove(file_path)
+                        download_queue.task_done()
+                        download_queue.put_overflow((url, page, rating))
+                        self.metrics.inc('retries')
+                        continue
+                    elif image_request.status_code == requests.codes.requested_range_not_satisfiable:
+                        self.remove_partial(download_path)
                     image_request.raise_for_status()
-                self.total_downloads += 1
+                    raise Exception('Unexpected response {}'.format(image_request.status_code))
+                # Index pages do not always tell file sizes, so
+                # the limit is checked again before the body
+                if self.max_file_size and (response_image_length(image_request) or 0) > self.max_file_size:
+                    image_request.close()
+                    self.remove_partial(download_path)
+                    self.metrics.inc('posts_oversized')
+                    self.journal.record('F', 'image', (url, page, rating))
+                    download_queue.task_done()
+                    continue
+                file_length = self.download_image(image_request, download_path, md5)
+                archive = archive_offset = None
+                if self.archive:
+                    archive, archive_offset = self.archive.add(download_path, '{}{}'.format(subfolder, file_name), md5)
+                    os.remove(download_path)
+                else:
+                    if self.syncer:
+                        self.syncer.add(download_path)
+                    if download_path != file_path:
+                        self.link_view(download_path, file_path)
+                if self.index:
+                    self.index.add(file_name_site(file_name), file_name_post_id(file_name), md5,
+                                   '{}{}'.format(subfolder, file_name), file_length, rating,
+                                   archive=archive, archive_offset=archive_offset)
+                with self.downloads_lock:
+                    self.total_downloads += 1
+                self.metrics.inc('images_downloaded')
+                self.retry_scheduler.forget('image', (url, page, rating))
+                self.journal.record('F', 'image', (url, page, rating))
                 download_queue.task_done()
-            except requests.exceptions.HTTPError:
-                self.write_traceback(page=page)
-            except Exception:
+            except requests.exceptions.HTTPError as error:
+                self.write_traceback(url=url, page=page)
+                self.retry_job(download_queue, 'image', (url, page, rating), str(error))
+            except Exception as error:
                 self.write_traceback(url=url, page=page)
                 self.print_exception()
-                download_queue.task_done()
-                download_queue.put((url, page, rating))
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
+                self.retry_job(download_queue, 'image', (url, page, rating), repr(error))
+            finally:
+                if running:
+                    self.downloader_concurrency.release()
+
+    def retry_job(self, job_queue, kind, job, reason):
+        """ Deals with a failed page or image job
+
+        Holds the job back for another attempt after a
+        backoff delay, or, once it failed max_attempts
+        times, appends it to the dead-letter file and
+        finishes it, so a job that can never succeed does
+        not keep the crawl from ending.
+        """
+        if self.stopping:
+            # The journal keeps the job for the next run
+            return
+        attempts = self.retry_scheduler.failed(kind, job)
+        if attempts < self.max_attempts:
+            self.retry_scheduler.schedule(job_queue, kind, job)
+            self.metrics.inc('retries')
+            return
+        url = job[0] if kind == 'image' else self.source.page_url(job, self.search_tags())
+        self.dead_letters.add(kind, job, url, attempts, reason)
+        self.retry_scheduler.forget(kind, job)
+        self.metrics.inc('dead_letters')
+        self.journal.record('F', kind, job)
+        job_queue.task_done()
+
+    def object_path(self, url, file_name):
+        """ Content-addressed path of an image
+
+        With content_addressed every image is stored once as
+        "objects/<ab>/<md5>.<ext>", <ab> being the first two
+        characters of the md5 in its URL. JPEG and sample
+        versions get "-jpeg" or "-sample" appended to the
+        md5 as they share the original's md5.
+        """
+        md5 = image_url_md5(url)
+        name = md5
+        if image_url_variant(url) != 'image':
+            name = '{}-{}'.format(md5, image_url_variant(url))
+        return '{}objects/{}/{}{}'.format(self.storage, md5[0:2], name, os.path.splitext(file_name)[1])
+
+    def image_folder(self, rating, file_name):
+        # Folder of an image relative to storage, the rating
+        # folder with "separate" and then the layout's one
+        subfolder = '{}/'.format(rating) if self.separate else ''
+        return subfolder + layout_folder(file_name, self.layout, self.layout_id_size)
+
+    def read_layout(self):
+        # Returns the (layout, id folder size) recorded in
+        # storage, None for storage without one
+        stored = configparser.ConfigParser()
+        if not stored.read('{}layout.ini'.format(self.storage)):
+            return None
+        return stored['LAYOUT'].get('layout', 'flat'), stored['LAYOUT'].getint('id_folder_size', self.layout_id_size)
+
+    def save_layout(self):
+        stored = configparser.ConfigParser()
+        stored['LAYOUT'] = {}
+        stored['LAYOUT']['layout'] = self.layout
+        stored['LAYOUT']['id_folder_size'] = str(self.layout_id_size)
+        with open('{}layout.ini'.format(self.storage), 'w') as layout_file:
+            stored.write(layout_file)
+
+    def storage_images(self):
+        """ Image files in storage
+
+        Walks storage in whichever layout it is and yields
+        the path relative to storage and the rating folder
+        (None outside of them) of every image. objects/ of
+        content_addressed, shards/ of crawl_shards and the
+        archive shards are left out.
+        """
+        for folder, folders, file_names in os.walk(self.storage):
+            relative_folder = os.path.relpath(folder, self.storage).replace(os.sep, '/')
+            if relative_folder == '.':
+                relative_folder = ''
+                folders[:] = [name for name in folders if name not in ('objects', 'shards', 'archives')]
+            else:
+                relative_folder += '/'
+            rating = relative_folder.split('/')[0]
+            for file_name in file_names:
+                if file_name_post_id(file_name) is None or file_name.endswith(
+                        ('.part', '.meta', '.link', '.progress', '.log', '.db', '.db-wal', '.db-shm', '.ini', '.tmp')):
+                    continue
+                yield relative_folder + file_name, rating if rating in RATINGS.values() else None
+
+    def migrate_layout(self, layout):
+        """ Moves storage into another layout
+
+        Renames every image to where the layout keeps it,
+        updates its path in the download index and records
+        the layout in storage, so later crawls use it too.
+        Renaming keeps the hardlinks into objects/ intact
+        and an interrupted migration can simply be run
+        again. Partial downloads are left behind and start
+        over. Returns the amount of images moved.
+        """
+        if self.use_index and not self.index:
+            self.index = download_index('{}downloads.db'.format(self.storage))
+        syncer = sync_batcher(self.fsync_batch) if self.fsync_batch else False
+        old_folders = set()
+        moved = 0
+        for relative_path, rating in self.storage_images():
+            file_name = relative_path.split('/')[-1]
+            new_path = '{}{}{}'.format('{}/'.format(rating) if rating else '',
+                                       layout_folder(file_name, layout, self.layout_id_size), file_name)
+            if new_path == relative_path:
+                continue
+            os.makedirs(os.path.dirname('{}{}'.format(self.storage, new_path)), exist_ok=True)
+            os.replace('{}{}'.format(self.storage, relative_path), '{}{}'.format(self.storage, new_path))
+            if syncer:
+                syncer.add('{}{}'.format(self.storage, new_path))
+            if self.index:
+                self.index.move(file_name_site(file_name), file_name_post_id(file_name), relative_path, new_path)
+            old_folders.add(os.path.dirname(relative_path))
+            moved += 1
+        if syncer:
+            syncer.close()
+        # Folders of the old layout left empty are removed
+        for folder in sorted(old_folders, key=len, reverse=True):
+            while folder and folder not in RATINGS.values():
+                try:
+                    os.rmdir('{}{}'.format(self.storage, folder))
+                except OSError:
+                    break
+                folder = os.path.dirname(folder)
+        self.layout = layout
+        self.save_layout()
+        return moved
+
+    def link_view(self, object_path, file_path):
+        # Hardlinks an object to its place in the rating/site
+        # layout, copies it where hardlinks are not supported
+        temp_path = '{}.link'.format(file_path)
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        try:
+            os.link(object_path, temp_path)
+        except OSError:
+            shutil.copyfile(object_path, temp_path)
+        os.replace(temp_path, file_path)
+        if self.syncer:
+            self.syncer.add(file_path)
+
+    def resume_headers(self, file_path):
+        """ Request headers resuming a partial download
+
+        A partial download is kept as "<file>.part" with its
+        expected length and validator (ETag or Last-Modified)
+        in "<file>.part.meta". If both are present a Range
+        request continuing after the bytes already on disk
+        is made. If-Range makes the server send the whole
+        image instead if it has changed since.
+        """
+        temp_path = '{}.part'.format(file_path)
+        meta_path = '{}.part.meta'.format(file_path)
+        if not os.path.isfile(temp_path) or not os.path.isfile(meta_path):
+            return {}
+        partial = configparser.ConfigParser(interpolation=None)
+        partial.read(meta_path)
+        try:
+            validator = partial['PARTIAL']['validator']
+            expected_length = partial['PARTIAL']['length']
+        except KeyError:
+            validator = ''
+            expected_length = ''
+        file_length = os.path.getsize(temp_path)
+        if not validator or file_length == 0 or (expected_length and file_length >= int(expected_length)):
+            self.remove_partial(file_path)
+            return {}
+        return {'Range': 'bytes={}-'.format(file_length), 'If-Range': validator}
+
+    def remove_partial(self, file_path):
+        # Removes the partial download of file_path and its metadata
+        for partial_path in ['{}.part'.format(file_path), '{}.part.meta'.format(file_path)]:
+            if os.path.isfile(partial_path):
+                os.remove(partial_path)
+
+    def save_partial_meta(self, file_path, expected_length, image_request):
+        # Records what a partial download has to match to be resumed
+        validator = image_request.headers.get('etag', '')
+        if validator.startswith('W/'):  # Weak validators cannot be used for ranges
+            validator = ''
+        if not validator:
+            validator = image_request.headers.get('last-modified', '')
+        partial = configparser.ConfigParser(interpolation=None)
+        partial['PARTIAL'] = {}
+        partial['PARTIAL']['url'] = image_request.url
+        partial['PARTIAL']['length'] = '' if expected_length is None else str(expected_length)
+        partial['PARTIAL']['validator'] = validator
+        with open('{}.part.meta'.format(file_path), 'w') as meta:
+            partial.write(meta)
+
+    def preallocate_file(self, file, length):
+        # Reserves the disk space of a whole image before it
+        # is written, which keeps large archives unfragmented;
+        # returns whether it did
+        if not self.preallocate or not length or not hasattr(os, 'posix_fallocate'):
+            return False
+        try:
+            os.posix_fallocate(file.fileno(), 0, length)
+        except OSError:
+            return False
+        return True
+
+    def download_image(self, image_request, file_path, md5=None):
+        """ Stream an image into storage
+
+        Writes the response body chunk by chunk into a
+        temporary ".part" file next to file_path, so only
+        one chunk per downloader is held in memory. The
+        byte count is checked against content-length while
+        streaming and the temporary file is renamed onto
+        file_path only when it is complete.
+
+        A 206 response to a resume request is appended to
+        the existing ".part" file. Interrupted downloads keep
+        their ".part" file so they can be resumed; only files
+        that turn out larger than expected are thrown away.
+
+        The disk space of a new image is reserved from its
+        content-length before the first chunk is written.
+
+        The md5 of the image is computed while streaming,
+        starting with the bytes of a resumed ".part" file.
+        If md5 is given, an image that does not match it is
+        corrupt and thrown away as well.
+        """
+        temp_path = '{}.part'.format(file_path)
+        faulty = False
+        file_hash = hashlib.md5()
+        try:
+            if image_request.status_code == requests.codes.partial_content:
+                # Content-Range: bytes <first>-<last>/<total>
+                content_range = re.match(r'bytes (\d+)-\d+/(\d+)', image_request.headers.get('content-range', ''))
+                file_length = os.path.getsize(temp_path) if os.path.isfile(temp_path) else 0
+                if content_range is None or int(content_range.group(1)) != file_length:
+                    faulty = True
+                    raise Exception('Faulty download')
+                expected_length = int(content_range.group(2))
+                mode = 'ab'
+                with open(temp_path, 'rb') as partial:
+                    for block in iter(lambda: partial.read(self.chunk_size), b''):
+                        file_hash.update(block)
+            else:
+                expected_length = image_request.headers.get('content-length')
+                if expected_length is not None:
+                    expected_length = int(expected_length)
+                self.save_partial_meta(file_path, expected_length, image_request)
+                file_length = 0
+                mode = 'wb'
+
+            write_time = 0
+            host = urllib.parse.urlsplit(image_request.url).netloc
+            with open(temp_path, mode) as file:
+                preallocated = mode == 'wb' and self.preallocate_file(file, expected_length)
+                try:
+                    for chunk in image_request.iter_content(chunk_size=self.chunk_size):
+                        # Not reading the socket while throttled
+                        # slows the server down through TCP
+                        self.bandwidth.consume(host, len(chunk))
+                        if self.lease_lost.is_set():
+                            raise Exception('Shard lease lost')
+                        start = time.perf_counter()
+                        file_length += file.write(chunk)
+                        write_time += time.perf_counter() - start
+                        file_hash.update(chunk)
+                        self.metrics.inc('image_bytes', len(chunk))
+                        if expected_length is not None and file_length > expected_length:
+                            faulty = True
+                            raise Exception('Faulty download')
+                finally:
+                    # A cut off download is resumed after the
+                    # bytes received, not the reserved ones
+                    if preallocated:
+                        file.truncate(file_length)
+            self.metrics.observe('disk_write', write_time)
+            if expected_length is not None and file_length != expected_length:
+                raise Exception('Faulty download')
+            if md5 is not None and file_hash.hexdigest() != md5:
+                faulty = True
+                self.metrics.inc('corrupt_images')
+                raise Exception('Faulty download')
+            os.replace(temp_path, file_path)
+            self.remove_partial(file_path)
+        except Exception:
+            if faulty:
+                self.remove_partial(file_path)
+            raise
+        finally:
+            image_request.close()
+        return file_length
 
     def crawl_post_page_worker(self, post_queue, download_queue):
         """ Crawl the post list page and find posts
@@ -414,54 +3451,119 @@ class konadl:
         URL before handing them to the image downloader.
         """
         while True:
+            running = False
             try:
                 page = post_queue.get()
                 if page is None:
                     self.print_thread_exit(
                         str(threading.current_thread().name))
                     break
+                # Wait for the concurrency limit to allow one more
+                self.crawler_concurrency.acquire()
+                running = True
+                self.journal.record('S', 'page', page)
                 self.print_crawling_page(page)
-                page_source = requests.get(
-                    '{}/post?page={}&tags='.format(self.site_root, page), headers=self.headers)
-                if page_source.status_code != requests.codes.ok:
+                page_source, index_page = self.fetch_index(self.source.page_url(page, self.search_tags()))
+                if index_page is None:
                     if page_source.status_code == 429:
                         self.print_429()
-                    post_queue.task_done()
-                    post_queue.put(page)
+                        post_queue.task_done()
+                        post_queue.put_overflow(page)
+                        self.metrics.inc('retries')
+                        continue
                     page_source.raise_for_status()
-                soup = BeautifulSoup(page_source.text, "html.parser")
-                # Find large image link and ratings
-                posts_list = soup.find('ul', {'id': 'post-list-posts'})
-                posts = posts_list.findAll('li')
+                    raise Exception('Unexpected response {}'.format(page_source.status_code))
 
+                posts = index_page['posts']
+                self.metrics.inc('posts_found', len(posts))
                 for post in posts:
-                    alt = post.find('img', alt=True)['alt']
-                    rating = False
-                    if 'Rating: Safe'in alt and self.safe:
-                        rating = 'safe'
-                    elif 'Rating: Questionable' in alt and self.questionable:
-                        rating = 'questionable'
-                    elif 'Rating: Explicit' in alt and self.explicit:
-                        rating = 'explicit'
-                    if rating:
-                        url = post.find('a', {'class': 'directlink'})['href']
-                        if 'https:' not in url:
-                            url = '{}{}'.format('https:', url)
-                        self.download_queue.put((url, page, rating))
+                    self.enqueue_post(post, page)
+                self.metrics.inc('pages_crawled')
+                self.retry_scheduler.forget('page', page)
+                self.journal.record('F', 'page', page)
                 post_queue.task_done()
-            except requests.exceptions.HTTPError:
+            except requests.exceptions.HTTPError as error:
                 self.write_traceback(page=page)
-            except Exception:
+                self.retry_job(post_queue, 'page', page, str(error))
+            except Exception as error:
                 self.write_traceback(page=page)
                 self.print_exception()
-                post_queue.task_done()
-                post_queue.put(page)
+                self.retry_job(post_queue, 'page', page, repr(error))
+            finally:
+                if running:
+                    self.crawler_concurrency.release()
+
+    def import_storage(self, hash_files=False):
+        """ Builds the download index from storage
+
+        Walks the storage directory (with the rating folders
+        used by "separate" and the folders of its layout) and
+        records every image found in the download index, so
+        images downloaded before the index existed are not
+        downloaded again. Images packed into archive shards
+        are recorded from the shards' sidecar indexes. Reading
+        the md5 of every file is optional as it reads the
+        whole archive. Returns the amount of images recorded.
+        """
+        if not self.index:
+            self.index = download_index('{}downloads.db'.format(self.storage))
+        imported = 0
+        for relative_path, rating in self.storage_images():
+            file_path = '{}{}'.format(self.storage, relative_path)
+            file_name = relative_path.split('/')[-1]
+            md5 = None
+            if hash_files:
+                md5 = file_md5(file_path)
+            self.index.add(file_name_site(file_name), file_name_post_id(file_name), md5, relative_path,
+                           os.path.getsize(file_path), rating, os.path.getmtime(file_path))
+            imported += 1
+        archive_folder = '{}archives/'.format(self.storage)
+        if os.path.isdir(archive_folder):
+            for sidecar_name in sorted(os.listdir(archive_folder)):
+                if not sidecar_name.endswith('.index'):
+                    continue
+                shard_name = sidecar_name[:-len('.index')]
+                timestamp = os.path.getmtime('{}{}'.format(archive_folder, sidecar_name))
+                for entry in archive_entries('{}{}'.format(archive_folder, sidecar_name)):
+                    file_name = entry['name'].split('/')[-1]
+                    if file_name_post_id(file_name) is None:
+                        continue
+                    rating = entry['name'].split('/')[0]
+                    self.index.add(file_name_site(file_name), file_name_post_id(file_name), entry['md5'], entry['name'],
+                                   entry['size'], rating if rating in RATINGS.values() else None, timestamp,
+                                   shard_name, entry['offset'])
+                    imported += 1
+        return imported
+
+    def read_archived(self, site, post_id):
+        """ Reads an image back from its archive shard
+
+        Looks the post up in the download index and reads
+        its bytes straight off the shard at the recorded
+        offset. Returns None if the post was not packed
+        into an archive shard.
+        """
+        if not self.index:
+            self.index = download_index('{}downloads.db'.format(self.storage))
+        archived = self.index.find_archived(site, post_id)
+        if archived is None:
+            return None
+        shard_name, offset, size = archived
+        with open('{}archives/{}'.format(self.storage, shard_name), 'rb') as shard:
+            shard.seek(offset)
+            return shard.read(size)
+
+    def progress_path(self, file_name):
+        return '{}{}'.format(self.progress_dir or self.storage, file_name)
 
     def progress_files_present(self):
         # Determines if the progress files are present
-        self.progress_files = ['{}download_queue.progress'.format(self.storage),
-                               '{}post_queue.progress'.format(self.storage)]
-        for file in self.progress_files:
+        self.progress_files = [self.progress_path('download_queue.progress'),
+                               self.progress_path('post_queue.progress'),
+                               self.progress_path('jobs.journal')]
+        if os.path.isfile(self.progress_files[2]):
+            return bool(job_journal(self.progress_files[2]).unfinished())
+        for file in self.progress_files[:2]:
             if not os.path.isfile(file):
                 return False
         return True
@@ -469,6 +3571,7 @@ class konadl:
     def remove_progress_files(self):
         # Remove progress files
         # Called when download is fully finished
+        self.progress_files_present()
         for file in self.progress_files:
             try:
                 os.remove(file)
@@ -476,36 +3579,26 @@ class konadl:
                 pass
 
     def metadata_present(self):
-        return os.path.isfile('{}metadata.progress'.format(self.storage))
+        return os.path.isfile(self.progress_path('metadata.progress'))
 
     def remove_metatada(self):
         # Remove metadata
         # Called when an old download progress is to be
         # removed
         try:
-            os.remove('{}metadata.progress'.format(self.storage))
+            os.remove(self.progress_path('metadata.progress'))
         except FileNotFoundError:
             pass
 
     def save_queues(self):
-        """ Saves the queues to files
+        """ Saves the queues
 
-        This method should be called before the queue is cleared.
-        It will write all the items in download_queue and page_queue
-        into the progress files.
+        Every job is already recorded in the job journal as it
+        is queued, started and finished, so saving the queues
+        only has to make sure the journal is on disk.
         """
-        with open('{}download_queue.progress'.format(self.storage), 'w') as download_progress:
-            while not self.download_queue.empty():
-                link, page, rating = self.download_queue.get()
-                download_progress.write('{}|{}|{}\n'.format(link, str(page), rating))
-                self.download_queue.task_done()
-            download_progress.close()
-
-        with open('{}post_queue.progress'.format(self.storage), 'w') as post_progress:
-            while not self.post_queue.empty():
-                post_progress.write('{}\n'.format(self.post_queue.get()))
-                self.post_queue.task_done()
-            post_progress.close()
+        if self.journal:
+            self.journal.sync()
 
     def save_metadata(self):
         """ Saves the settings and stats into file
@@ -522,48 +3615,112 @@ class konadl:
         progress['STATISTICS'] = {}
         progress['STATISTICS']['total_downloads'] = str(self.total_downloads)
         progress['STATISTICS']['time_elapsed'] = str(round((time.time() - self.begin_time), 5))
+        if self.metrics.counters['image_bytes']:
+            self.download_rate = self.metrics.counters['image_bytes'] / (time.time() - self.begin_time)
+        progress['STATISTICS']['download_rate'] = str(round(self.download_rate, 1))
         if self.job_done:
             progress['STATISTICS']['total_downloads'] = '0'
             progress['STATISTICS']['time_elapsed'] = '0'
         progress['UPDATING'] = {}
-        progress['UPDATING']['previous_newest_id'] = self.current_newest_id
-
-        with open('{}metadata.progress'.format(self.storage), 'w') as progressf:
+        progress['UPDATING']['previous_newest_id'] = str(self.current_newest_id)
+        progress['CRAWLING'] = {}
+        progress['CRAWLING']['post_source'] = self.post_source
+        progress['CRAWLING']['tags'] = self.tags.replace('%', '%%')
+        progress['CRAWLING']['content_addressed'] = str(int(self.content_addressed))
+        progress['CRAWLING']['archive_format'] = self.archive_format or ''
+        progress['CRAWLING']['archive_size'] = str(self.archive_size)
+        progress['CRAWLING']['variant'] = self.variant
+        progress['CRAWLING']['min_resolution'] = str(self.min_resolution)
+        progress['CRAWLING']['max_file_size'] = str(self.max_file_size)
+        progress['CRAWLING']['max_resolution'] = str(self.max_resolution)
+        progress['CRAWLING']['id_range'] = ''
+        if self.id_range and not self.job_done:
+            progress['CRAWLING']['id_range'] = '{}..{}'.format(*self.id_range)
+
+        with open(self.progress_path('metadata.progress'), 'w') as progressf:
             progress.write(progressf)
 
     def read_queues(self):
         """ Reads the download progress
 
-        Parses the download progress and returns
-        the configuration file contents.
+        Rebuilds the queues from the unfinished jobs in the
+        job journal, or from the progress files written by
+        older versions, and reads the metadata. Returns the
+        restored jobs as (kind, job) pairs.
         """
         self.print_loading_progress()
 
         try:
-            with open('{}download_queue.progress'.format(self.storage), 'r') as download_progress:
-                for line in download_progress:
-                    self.download_queue.put((line.split('|')[0], int(line.split('|')[1]), line.split('|')[2].strip('\n')))
-                download_progress.close()
-
-            with open('{}post_queue.progress'.format(self.storage), 'r') as post_progress:
-                for line in post_progress:
-                    self.post_queue.put(int(line.strip('\n')))
-                post_progress.close()
-
+            journal_file = self.progress_path('jobs.journal')
+            if os.path.isfile(journal_file):
+                restored_jobs = job_journal(journal_file).unfinished()
+            else:
+                restored_jobs = []
+                with open(self.progress_path('download_queue.progress'), 'r') as download_progress:
+                    for line in download_progress:
+                        restored_jobs.append(('image', (line.split('|')[0], int(line.split('|')[1]), line.split('|')[2].strip('\n'))))
+                    download_progress.close()
+
+                with open(self.progress_path('post_queue.progress'), 'r') as post_progress:
+                    for line in post_progress:
+                        restored_jobs.append(('page', int(line.strip('\n'))))
+                    post_progress.close()
+
+            for kind, job in restored_jobs:
+                if kind == 'page':
+                    self.post_queue.put_overflow(job)
+                else:
+                    self.download_queue.put_overflow(job)
             self.read_metadata()
+            return restored_jobs
         except (KeyError, ValueError):
             self.print_faulty_progress_file()
+            self.log_writer.flush()
             exit(1)
 
     def read_metadata(self):
+        """ Reads the settings and stats from file
+
+        The ratings, tag query, post source and id range of
+        the stored search always apply: page numbers in the
+        progress files and the ids an update starts from
+        belong to that search. A pinned one that differs is
+        warned about. The download options stored (storage
+        format, variant and limits) only apply if they are
+        not in self.pinned_options.
+        """
         progress = configparser.ConfigParser()
-        progress.read('{}metadata.progress'.format(self.storage))
-        self.safe = bool(int(progress['RATINGS']['safe']))
-        self.questionable = bool(int(progress['RATINGS']['questionable']))
-        self.explicit = bool(int(progress['RATINGS']['explicit']))
+        progress.read(self.progress_path('metadata.progress'))
+        stored = {'safe': bool(int(progress['RATINGS']['safe'])),
+                  'questionable': bool(int(progress['RATINGS']['questionable'])),
+                  'explicit': bool(int(progress['RATINGS']['explicit']))}
         self.total_downloads += int(progress['STATISTICS']['total_downloads'])
         self.time_elapsed = float(progress['STATISTICS']['time_elapsed'])
-        self.previous_newest_id = progress['UPDATING']['previous_newest_id']
+        self.download_rate = progress['STATISTICS'].getfloat('download_rate', self.download_rate)
+        self.previous_newest_id = post_id_number(progress['UPDATING']['previous_newest_id'])
+        if progress.has_section('CRAWLING'):
+            crawling = progress['CRAWLING']
+            stored['post_source'] = crawling.get('post_source', self.post_source)
+            stored['tags'] = crawling.get('tags', self.tags)
+            id_range = crawling.get('id_range', '')
+            if id_range:
+                stored['id_range'] = tuple(int(post_id) for post_id in id_range.split('..'))
+            download_options = {'content_addressed': crawling.getboolean('content_addressed', self.content_addressed),
+                                'archive_format': crawling.get('archive_format', self.archive_format or '') or False,
+                                'archive_size': crawling.getint('archive_size', self.archive_size),
+                                'variant': crawling.get('variant', self.variant),
+                                'min_resolution': crawling.getint('min_resolution', self.min_resolution),
+                                'max_file_size': crawling.getint('max_file_size', self.max_file_size),
+                                'max_resolution': crawling.getint('max_resolution', self.max_resolution)}
+            for option, value in download_options.items():
+                if option not in self.pinned_options:
+                    stored[option] = value
+        for option, value in stored.items():
+            if option in self.pinned_options and getattr(self, option) != value:
+                self.warn_stored_option(option, value)
+            setattr(self, option, value)
+        if progress.has_section('CRAWLING'):
+            self.process_crawling_options()
 
     @print_locker
     def warn_keyboard_interrupt(self):
@@ -571,6 +3728,11 @@ class konadl:
         print('[Main Thread] KeyboardInterrupt Caught!')
         print('[Main Thread] Flushing queues and exiting')
 
+    @print_locker
+    def warn_stored_option(self, option, value):
+        # A pinned option differs from the stored search
+        print('[Main Thread] Ignoring the {} given, the stored crawl uses {}'.format(option, value))
+
     @print_locker
     def print_saving_progress(self):
         # Tells the user that the progress is being saved